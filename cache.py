@@ -1,106 +1,686 @@
 # -*- coding: utf-8 -*-
 
+import functools
 import logging
+import mmap
+import os
+import sys
+import threading
+from collections import deque, OrderedDict
+from time import time
 
-from dbxobject import FileHandle, get_new_file_instance
+from dbxobject import DbxEntry, FileHandle, get_new_file_instance
 
 logger = logging.getLogger(__name__)
 
 
+# Run method under instance lock
+def synchronized(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+# Cache key of path, Dropbox paths are case-insensitive
+def cache_key(path):
+    if isinstance(path, str):
+        path = path.decode('utf-8')
+    return path.lower()
+
+
+class CacheItem(object):
+    """
+    Node of the cache path trie, metadata attributes are served from the underlying DbxEntry record.
+    entry is None for path components which are not cached themselves.
+    Folder children are indexed by lowercase name, listed holds time of the last complete listing.
+    ref is the CLOCK reference bit, None when node is not accounted in cache.
+    """
+    __slots__ = ('entry', 'created', 'cache_time', 'children', 'listed', 'ref')
+
+    def __init__(self, entry=None, cache_time=0):
+        self.entry = entry
+        self.created = time()
+        self.cache_time = cache_time
+        self.children = None
+        self.listed = None
+        self.ref = None
+
+    def __getattr__(self, name):
+        if self.entry is None:
+            raise AttributeError(name)
+        return getattr(self.entry, name)
+
+    @property
+    def key(self):
+        return cache_key(self.entry.path_lower)
+
+    @property
+    def is_expired(self):
+        return self.valid_until < int(time())
+
+    # Folder content is as old as its listing
+    @property
+    def valid_until(self):
+        created = min(self.created, self.listed) if self.listed is not None else self.created
+        return int(created) + self.cache_time
+
+    @property
+    def has_entries(self):
+        return self.listed is not None
+
+    @property
+    def sub_items(self):
+        if self.children is None:
+            return []
+        # values() copies children at once, cache may change meanwhile in other thread
+        return [x for x in self.children.values() if x.entry is not None]
+
+    def get_entry(self, path):
+        if self.children is None:
+            return None
+        item = self.children.get(os.path.basename(cache_key(path)))
+        return item if item is not None and item.entry is not None else None
+
+    def has_entry(self, path):
+        return self.get_entry(path) is not None
+
+    def add_entry(self, item):
+        if self.children is None:
+            self.children = {}
+        self.children[os.path.basename(item.key)] = item
+
+    def remove_entry(self, path):
+        if self.children is None:
+            return None
+        return self.children.pop(os.path.basename(cache_key(path)), None)
+
+
+# Approximate memory used by cached entry
+def entry_size(entry):
+    size = _NODE_SIZE + sys.getsizeof(entry)
+    for value in entry:
+        if value is not None:
+            size += sys.getsizeof(value)
+    return size
+
+
+_NODE_SIZE = sys.getsizeof(CacheItem())
+# Seconds change times are kept for listings in flight
+_CHANGE_WINDOW = 600
+
+
 class ItemCache(object):
+    """
+    Metadata cache, path trie of CacheItem nodes.
+    Size is bounded by max_entries and max_bytes, least recently used entries are evicted by CLOCK sweep.
+    Public methods are synchronized, network requests are never made under the lock.
+    """
     # For cache operations default 120s
     cache_time = 120
+    # Max number of cached entries, 0 means unlimited
+    max_entries = 0
+    # Approximate max memory of cached entries in bytes, 0 means unlimited
+    max_bytes = 0
 
     def __init__(self):
+        self._lock = threading.RLock()
         self.flush()
         super(ItemCache, self).__init__()
 
+    @synchronized
     def flush(self):
-        self._cache = {}
+        self._root = CacheItem()
+        self._clock = deque()
+        self._dropped = 0
+        self._pinned = {}
+        # Folder nodes changed by apply_changes and time of the change
+        self._changed = {}
+        # Folder nodes restored from disk, their listing is complete only once revalidated
+        self._restored = set()
+        self.entries = 0
+        self.bytes = 0
+        self.evictions = 0
+        self.hits = 0
+        self.misses = 0
 
+    @synchronized
+    def stats(self):
+        return {
+            'entries': self.entries,
+            'bytes': self.bytes,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'evictions': self.evictions,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+    @synchronized
     def is_in_cache(self, path):
-        return path in self._cache
+        return self._lookup(cache_key(path)) is not None
+
+    # Walk path trie down to node of key, missing nodes are created on demand
+    def _node(self, key, create=False):
+        node = self._root
+        for name in key.split('/'):
+            if not name:
+                continue
+            if create:
+                node = self._child(node, name)
+                continue
+            node = node.children.get(name) if node.children is not None else None
+            if node is None:
+                return None
+        return node
+
+    def _lookup(self, key):
+        node = self._node(key)
+        return node if node is not None and node.entry is not None else None
+
+    # Unlink node of key together with its subtree, returns detached node
+    def _detach(self, key):
+        parent = self._node(os.path.dirname(key))
+        name = os.path.basename(key)
+        if parent is None or not name or parent.children is None:
+            return None
+        return parent.children.pop(name, None)
+
+    # Store entry in trie node, subtree of folder is kept
+    def _set_entry(self, node, entry):
+        if not entry.is_folder:
+            self._drop_children(node)
+            node.listed = None
+        if node.ref is None:
+            self.entries += 1
+            self.bytes += entry_size(entry)
+            self._clock.append(node)
+        else:
+            self.bytes += entry_size(entry) - entry_size(node.entry)
+        node.ref = True
+        node.entry = entry
+        node.created = time()
+        node.cache_time = self.cache_time
+        return node
+
+    def _drop_children(self, node):
+        if node.children is not None:
+            for child in node.children.itervalues():
+                self._untrack(child)
+            node.children = None
+
+    # Remove subtree from cache accounting, nodes are dropped from clock lazily
+    def _untrack(self, node):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            self._restored.discard(node)
+            if node.ref is not None:
+                self.entries -= 1
+                self.bytes -= entry_size(node.entry)
+                self._dropped += 1
+                node.ref = None
+            if node.children is not None:
+                stack.extend(node.children.itervalues())
+
+    def _over_limit(self):
+        return (self.max_entries and self.entries > self.max_entries) or \
+               (self.max_bytes and self.bytes > self.max_bytes)
+
+    # CLOCK sweep, evicts unreferenced and unpinned entries together with their subtree
+    def _evict(self):
+        steps = 2 * len(self._clock)
+        while self._over_limit() and steps > 0:
+            steps -= 1
+            node = self._clock.popleft()
+            if node.ref is None:
+                self._dropped -= 1
+                continue
+            key = node.key
+            if self._node(key) is not node:
+                # Detached together with its parent
+                self._clock.append(node)
+                self._untrack(node)
+                continue
+            if node.ref or key in self._pinned or key == '/':
+                node.ref = False
+                self._clock.append(node)
+                continue
+            logger.debug('Evicting from cache:%s', key)
+            self._detach(key)
+            self._unlist(self._node(os.path.dirname(key)))
+            self._clock.append(node)
+            self._untrack(node)
+            self.evictions += 1
+        # Compact clock when most of it are dropped nodes
+        if self._dropped > 1024 and self._dropped > len(self._clock) / 2:
+            self._clock = deque(x for x in self._clock if x.ref is not None)
+            self._dropped = 0
+
+    # Protect path and its parents from eviction, used for open handles and pending uploads
+    @synchronized
+    def pin(self, path):
+        for key in self._parent_keys(cache_key(path)):
+            self._pinned[key] = self._pinned.get(key, 0) + 1
+
+    @synchronized
+    def unpin(self, path):
+        for key in self._parent_keys(cache_key(path)):
+            count = self._pinned.get(key, 0) - 1
+            if count > 0:
+                self._pinned[key] = count
+            else:
+                self._pinned.pop(key, None)
+
+    @synchronized
+    def is_pinned(self, path):
+        return cache_key(path) in self._pinned
+
+    @staticmethod
+    def _parent_keys(key):
+        keys = ['/']
+        while key not in ('/', ''):
+            keys.append(key)
+            key = os.path.dirname(key)
+        return keys
+
+    def _child(self, node, name):
+        if node.children is None:
+            node.children = {}
+        child = node.children.get(name)
+        if child is None:
+            child = node.children[name] = CacheItem()
+        return child
 
-    # Remove item from cache.
+    # Drop item and its subtree, parent listing does not describe folder content any more
+    @synchronized
     def remove(self, path):
         logger.debug('Called removeFromCache() Path: %s', path)
-        # Check whether this path exists within cache.
-        if not self.is_in_cache(path):
+        key = cache_key(path)
+        node = self._detach(key)
+        if node is None:
             logger.debug('Path not in cache: %s', path)
             return False
-
-        # Exist in cache
-        item = self.get(path)
-
-        # Item is file and parent exist - start removing parent
-        if item.is_file and self.is_in_cache(item.parent_path):
-            tmp = self.get(item.parent_path)
-            if tmp.is_folder:
-                self.remove(tmp.path)
-
-        # Check if path has been removed within parent removal stage - keeper point
-        if not self.is_in_cache(path):
-            logger.debug("Path has been already removed from cache:%s", path)
-            return True
-
-        # If is still in cache
-        if item.is_folder:
-            # Remove folder items from cache.
-            logger.debug('Removing childs of path from cache')
-            for tmp in item.sub_items:
-                tmp_path = tmp.path
-                logger.debug('Child removing from cache: %s', tmp_path)
-                if self.is_in_cache(tmp_path):
-                    self._cache.pop(tmp_path)
         logger.debug('Removing from cache:%s', path)
-        self._cache.pop(path)
+        self._untrack(node)
+        self._unlist(self._node(os.path.dirname(key)))
+        return node.entry is not None
+
+    # Folder content is not complete any more
+    def _unlist(self, folder):
+        folder.listed = None
+        self._restored.discard(folder)
+
+    # Item has been deleted on Dropbox, parent listing stays valid
+    @synchronized
+    def delete(self, path):
+        logger.debug('Deleting from cache:%s', path)
+        key = cache_key(path)
+        node = self._detach(key)
+        if node is None:
+            return False
+        self._untrack(node)
         return True
 
-    def _add(self, item):
-        item.cache_time = self.cache_time
-        self._cache[item.path] = item
+    # Item has been moved on Dropbox, cached subtree is moved in place
+    @synchronized
+    def move(self, old, item):
+        entry = item.to_entry()
+        node = self._detach(cache_key(old))
+        logger.debug('Moving in cache:%s -> %s', old, entry.path)
+        if node is not None and node.entry is not None:
+            self._rebase(node, node.entry, entry)
+        else:
+            # Placeholder can not be rebased, its cached descendants are dropped
+            if node is not None:
+                self._untrack(node)
+            node = CacheItem()
+        key = cache_key(entry.path_lower)
+        replaced = self._detach(key)
+        if replaced is not None:
+            self._untrack(replaced)
+        self._node(os.path.dirname(key), create=True).add_entry(self._set_entry(node, entry))
+        self._evict()
+        return node
+
+    # Rewrite paths of moved subtree
+    def _rebase(self, node, old, new):
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.entry is not None:
+                node.entry = node.entry._replace(
+                    path=new.path + node.entry.path[len(old.path):],
+                    path_lower=new.path_lower + node.entry.path_lower[len(old.path_lower):])
+            if node.children is not None:
+                stack.extend(node.children.itervalues())
 
-    # Just cache subitems
-    def add(self, item):
+    # Cache item, folder entries are cached as well, returns cached item.
+    # started is time the listing was requested, changes applied after it are not undone by the listing.
+    @synchronized
+    def add(self, item, started=None):
         logger.debug("Cache entry:%s", item.path)
-        self._add(item)
-        for tmp in item.sub_items:
-            if not tmp.is_deleted:
-                logger.debug("Cache sub-entry:%s", tmp.path)
-                self._add(tmp)
+        if started is None:
+            started = time()
+        entry = item.to_entry()
+        cached = self._set_entry(self._node(cache_key(entry.path_lower), create=True), entry)
+        if item.has_entries:
+            self.add_page(cached, item)
+            self.set_listed(cached, started)
+        self._evict()
+        return cached
+
+    # Cache entries of one list_folder page of folder, returns list of cached entries
+    @synchronized
+    def add_page(self, folder, page):
+        result = self._add_entries(folder, (DbxEntry.from_dict(x) for x in page.entries))
+        self._evict()
+        return result
+
+    # Restore folder listing, e.g. from persistent store.
+    # Entries answer lookups, folder is listed only after set_validated, local changes may be missing meanwhile.
+    @synchronized
+    def load(self, folder, entries):
+        node = self._set_entry(self._node(cache_key(folder.path_lower), create=True), folder)
+        self._add_entries(node, entries)
+        if node.listed is None:
+            self._restored.add(node)
+        self._evict()
+        return node
+
+    # Listing of path has been restored and waits for revalidation
+    @synchronized
+    def is_restored(self, path):
+        return self._lookup(cache_key(path)) in self._restored
+
+    # Apply entries of list_folder/continue result, returns number of changes.
+    # Only paths with cached parent are touched.
+    @synchronized
+    def apply_changes(self, entries):
+        changes = 0
+        now = time()
+        for tmp in entries:
+            entry = DbxEntry.from_dict(tmp)
+            key = cache_key(entry.path_lower)
+            parent = self._node(os.path.dirname(key))
+            if parent is None or parent.children is None and parent.entry is None:
+                continue
+            if entry.is_deleted:
+                self.delete(key)
+            else:
+                self._set_entry(self._child(parent, os.path.basename(key)), entry)
+            self._changed[parent] = now
+            changes += 1
+        # Only listings in flight need change times
+        for node, changed in self._changed.items():
+            if now - changed > _CHANGE_WINDOW:
+                del self._changed[node]
+        self._evict()
+        return changes
+
+    # Mark cached subtree of path as expired, it is refreshed on next access
+    @synchronized
+    def expire(self, path):
+        node = self._node(cache_key(path))
+        stack = [node] if node is not None else []
+        while stack:
+            node = stack.pop()
+            node.created = 0
+            if node.listed is not None:
+                node.listed = 0
+            if node.children is not None:
+                stack.extend(node.children.itervalues())
+
+    # Snapshot of complete folder listing taken under the lock, returns (folder entry, entries) or None
+    @synchronized
+    def listing(self, path):
+        folder = self._lookup(cache_key(path))
+        if folder is None or not folder.has_entries:
+            return None
+        return folder.entry, [x.entry for x in folder.sub_items]
+
+    # Folder content has been confirmed up to date, restored listing becomes complete
+    @synchronized
+    def set_validated(self, path):
+        folder = self._lookup(cache_key(path))
+        if folder in self._restored:
+            self._restored.discard(folder)
+        elif folder is None or not folder.has_entries:
+            return
+        folder.created = folder.listed = time()
+
+    def _add_entries(self, folder, entries):
+        result = []
+        if folder.children is None:
+            folder.children = {}
+        folder_key = folder.key
+        for entry in entries:
+            if entry.is_deleted:
+                continue
+            logger.debug("Cache sub-entry:%s", entry.path)
+            key = cache_key(entry.path_lower)
+            parent_key, name = os.path.split(key)
+            if parent_key == folder_key:
+                node = folder.children.get(name)
+                if node is None:
+                    node = folder.children[name] = CacheItem()
+            else:
+                # Entry of recursive listing
+                node = self._node(key, create=True)
+            result.append(self._set_entry(node, entry))
+        return result
+
+    # Folder content is complete and can be served from cache.
+    # Children not seen since listing has started are gone on Dropbox.
+    # Listing is not trusted if changes were applied to folder meanwhile, it could contain entries deleted since.
+    @synchronized
+    def set_listed(self, folder, started):
+        if self._changed.get(folder, 0) >= started:
+            logger.debug('Folder changed while being listed, listing is not complete')
+            self._unlist(folder)
+            return
+        if folder.children is None:
+            folder.children = {}
+        for name, node in folder.children.items():
+            if node.created < started and not (node.entry is not None and node.key in self._pinned):
+                del folder.children[name]
+                self._untrack(node)
+        folder.listed = time()
+        self._restored.discard(folder)
+
+    # Recursive listing of folder is complete, every sub folder can be served from cache
+    @synchronized
+    def set_tree_listed(self, folder, started):
+        stack = [folder]
+        while stack:
+            node = stack.pop()
+            self.set_listed(node, started)
+            # Folder changed while being listed is left unlisted, possibly without children
+            children = node.children or {}
+            stack.extend(x for x in children.itervalues() if x.entry is not None and x.entry.is_folder)
 
     # Get cached item
+    @synchronized
     def get(self, path):
-        return self._cache[path] if path in self._cache else None
+        item = self._lookup(cache_key(path))
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        item.ref = True
+        return item
+
+
+class BlockCache(object):
+    """
+    LRU cache of file content blocks.
+    Blocks are keyed by (path_lower, rev) of the file and block index, so new revisions never hit stale data.
+    Blocks in memory are bounded by max_bytes, mmaps of stored block files by max_maps as every map holds
+    a file descriptor. Mapped blocks do not count to memory, their pages belong to the kernel page cache.
+    """
+    # Size of cached block in bytes, reads are fetched from Dropbox in ranges of this size
+    block_size = 4 * 1024 * 1024
+    # Max memory of cached blocks in bytes
+    max_bytes = 64 * 1024 * 1024
+    # Max number of cached mmaps of stored blocks
+    max_maps = 256
+
+    def __init__(self):
+        super(BlockCache, self).__init__()
+        self._lock = threading.Lock()
+        self._blocks = OrderedDict()
+        self._maps = OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {
+            'blocks': len(self._blocks),
+            'bytes': self.bytes,
+            'maps': len(self._maps),
+            'block_size': self.block_size,
+            'max_bytes': self.max_bytes,
+            'max_maps': self.max_maps,
+            'evictions': self.evictions,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+    # Returns cached block or None
+    def get(self, key, index):
+        with self._lock:
+            for table in (self._blocks, self._maps):
+                data = table.pop((key, index), None)
+                if data is not None:
+                    self.hits += 1
+                    table[(key, index)] = data
+                    return data
+            self.misses += 1
+            return None
+
+    def has(self, key, index):
+        return (key, index) in self._blocks or (key, index) in self._maps
+
+    def put(self, key, index, data):
+        with self._lock:
+            old = self._blocks.pop((key, index), None)
+            if old is not None:
+                self.bytes -= len(old)
+            self._maps.pop((key, index), None)
+            if isinstance(data, mmap.mmap):
+                self._maps[(key, index)] = data
+            else:
+                self._blocks[(key, index)] = data
+                self.bytes += len(data)
+            while self.bytes > self.max_bytes and len(self._blocks) > 1:
+                tmp, old = self._blocks.popitem(last=False)
+                self.bytes -= len(old)
+                self.evictions += 1
+            # Evicted map is not closed, a reader may still copy from it.
+            # Its descriptor is released with the last reference.
+            while len(self._maps) > self.max_maps:
+                self._maps.popitem(last=False)
+                self.evictions += 1
+
+
+class SingleFlight(object):
+    """
+    Table of requests in flight.
+    Concurrent callers of the same key wait for the first one and share its result or exception.
+    """
+
+    def __init__(self):
+        super(SingleFlight, self).__init__()
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.shared = 0
+
+    # Returns func(*args), called only once for all concurrent callers of key
+    def do(self, key, func, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class _Call(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
 
 
 class FileHandleCache(object):
+    """
+    Table of open file handles.
+    Slots are reused from a free list, handle number carries generation of its slot in upper 32 bits,
+    so a stale handle never resolves to a reused slot. Lookups are lock free, allocation and release are synchronized.
+    """
+    # Max number of open handles, 0 means unlimited
+    max_handles = 0
+
     def __init__(self):
         super(FileHandleCache, self).__init__()
+        self._lock = threading.Lock()
         self.openfh = {}
+        self._free = []
+        self._generations = {}
+        self._next_slot = 1
 
     def is_exist(self, index):
         return index in self.openfh
 
-    # Returns file handle index
+    # Returns file handle index or False if table is full
+    @synchronized
     def new_fh(self, mode='r', item=None, path=None):
+        if self._free:
+            slot = self._free.pop()
+        elif self.max_handles and self._next_slot > self.max_handles:
+            return False
+        else:
+            slot = self._next_slot
+            self._next_slot += 1
         if item is None:
             item = get_new_file_instance(path)
-        for i in range(1, 8193):
-            if i not in self.openfh:
-                self.openfh[i] = FileHandle(item, mode)
-                return i
-        return False
+        index = self._generations.get(slot, 0) << 32 | slot
+        self.openfh[index] = FileHandle(item, mode)
+        return index
 
     # Release filehandle if exist
+    @synchronized
     def release_fh(self, index):
-        if not self.is_exist(index):
+        if self.openfh.pop(index, None) is None:
             return False
-        self.openfh.pop(index)
+        slot = index & 0xffffffff
+        self._generations[slot] = (index >> 32) + 1
+        self._free.append(slot)
         return True
 
     def get_fh(self, index):
-        return self.openfh[index] if self.is_exist(index) else False
+        return self.openfh.get(index, False)
 
     def is_locked(self, index):
         return self.get_fh(index).is_locked if self.is_exist(index) else False
@@ -3,23 +3,142 @@
 import httplib
 import json
 import logging
+import socket
+import threading
 import urllib
-import urllib2
+import urlparse
+from time import time
 
 from dbxobject import DbxResponse, DbxObject
 
 logger = logging.getLogger(__name__)
 
 
+class ConnectionPool(object):
+    """
+    Thread-safe pool of persistent HTTPS connections, one pool per host.
+
+    Connections are checked out for the duration of a request (or of a streamed
+    download) and given back once the response has been read completely.
+    When all pooled connections are busy a new one is opened, at most
+    pool_size idle connections are kept per host.
+    """
+    # Max idle connections kept per host
+    pool_size = 8
+    # Idle connections older than this (seconds) are closed instead of reused
+    idle_timeout = 60
+    # Socket timeout (seconds)
+    timeout = 60
+    connection_class = httplib.HTTPSConnection
+
+    def __init__(self):
+        super(ConnectionPool, self).__init__()
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    # Returns tuple (connection, reused)
+    def get(self, host):
+        now = time()
+        with self._lock:
+            idle = self._idle.get(host)
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used <= self.idle_timeout:
+                    return conn, True
+                conn.close()
+        logger.debug("New connection to host:%s", host)
+        return self.connection_class(host, timeout=self.timeout), False
+
+    # Give connection back to the pool
+    def put(self, host, conn):
+        now = time()
+        with self._lock:
+            idle = self._idle.setdefault(host, [])
+            # Oldest connections are at the bottom of the stack
+            while idle and now - idle[0][1] > self.idle_timeout:
+                idle.pop(0)[0].close()
+            if len(idle) < self.pool_size:
+                idle.append((conn, now))
+                return
+        conn.close()
+
+    def idle_count(self, host):
+        with self._lock:
+            return len(self._idle.get(host, []))
+
+    # Close all idle connections
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn, last_used in connections:
+                conn.close()
+
+
+class PooledResponse(object):
+    """
+    Wraps httplib response, connection is returned to the pool when whole body has been read.
+    """
+
+    def __init__(self, pool, host, conn, response):
+        super(PooledResponse, self).__init__()
+        self._pool = pool
+        self._host = host
+        self._conn = conn
+        self._response = response
+        self._release_if_done()
+
+    @property
+    def status(self):
+        return self._response.status
+
+    @property
+    def reason(self):
+        return self._response.reason
+
+    @property
+    def headers(self):
+        return self._response.msg
+
+    # File like object used for streamed downloads
+    @property
+    def fp(self):
+        return self
+
+    def read(self, amt=None):
+        data = self._response.read(amt)
+        self._release_if_done()
+        return data
+
+    def _release_if_done(self):
+        if self._conn is not None and self._response.isclosed():
+            conn, self._conn = self._conn, None
+            self._pool.put(self._host, conn)
+
+    # Close response before body has been read, connection can not be reused
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._response.close()
+            conn.close()
+
+
+# Server closed connection before sending any response, typical for idle keep-alive connection
+def _no_status_line(e):
+    return isinstance(e, httplib.BadStatusLine) and (not e.line or e.line == "''" or e.line.startswith('No status line'))
+
+
 class DbxRequest(object):
     access_token = None
+    pool = ConnectionPool()
     default_content_type = "application/json"
     binary_content_type = "application/octet-stream"
 
     def __init__(self, binary=False, dbx_arg=None, access_token=None, user_agent="apiRequest/tools.schmidt.ps",
-                 extra_params=None, content_type="application/json"):
+                 extra_params=None, content_type="application/json", authorization=True):
         if access_token is not None:
             self.access_token = access_token
+        self.authorization = authorization
         self.dbx_arg = dbx_arg
         self.user_agent = user_agent
         self.binary = binary
@@ -33,7 +152,7 @@ class DbxRequest(object):
             headers.update({"Content-Type": self.default_content_type})
         if self.binary:
             headers.update({"Content-Type": self.binary_content_type})
-        if self.access_token is not None:
+        if self.access_token is not None and self.authorization:
             headers.update({'Authorization': 'Bearer ' + self.access_token})
         if self.dbx_arg is not None:
             headers.update({"Dropbox-API-Arg": json.dumps(self.dbx_arg)})
@@ -60,19 +179,20 @@ class DbxRequest(object):
         error_code = 0
         error_summary = ""
         try:
-            req = urllib2.Request(url, data=body, headers=headers)
-            response = urllib2.urlopen(req)
-            h = response.headers.dict
-            if 'dropbox-api-result' in h:
-                api_result = h['dropbox-api-result']
-        except urllib2.HTTPError as e:
-            logger.exception('apiRequest failed. HTTPError: %s', e.code)
-            api_result = e.read()
-            error_summary = e.msg
-            error_code = e.code
-        except urllib2.URLError as e:
-            logger.error('apiRequest failed. URLError: %s', e.reason)
-            raise Exception('apiRequest failed. URLError: %s', e.reason)
+            response = self._request(url, body, headers)
+            if response.status >= 400:
+                logger.error('apiRequest failed. HTTPError: %s', response.status)
+                api_result = response.read()
+                error_summary = response.reason
+                error_code = response.status
+                response = None
+            else:
+                h = response.headers.dict
+                if 'dropbox-api-result' in h:
+                    api_result = h['dropbox-api-result']
+        except socket.error as e:
+            logger.error('apiRequest failed. Socket error: %s', e)
+            raise Exception('apiRequest failed. Socket error: %s', e)
         except httplib.HTTPException as e:
             logger.exception('apiRequest failed. HTTPException...')
             raise Exception('apiRequest failed. HTTPException')
@@ -86,6 +206,28 @@ class DbxRequest(object):
             error_code=error_code,
             error_summary=error_summary)
 
+    # Send request over pooled connection, returns PooledResponse
+    def _request(self, url, body, headers):
+        parts = urlparse.urlsplit(url)
+        host = parts.netloc
+        selector = parts.path
+        if parts.query:
+            selector += '?' + parts.query
+        while True:
+            conn, reused = self.pool.get(host)
+            sent = False
+            try:
+                conn.request('POST', selector, body, headers)
+                sent = True
+                return PooledResponse(self.pool, host, conn, conn.getresponse())
+            except (socket.error, httplib.HTTPException) as e:
+                conn.close()
+                # Keep-alive connection could be closed by server meanwhile, retry on fresh one.
+                # Request which may have been processed is not repeated, uploads are not idempotent.
+                if not reused or (sent and not _no_status_line(e)):
+                    raise
+                logger.debug("Stale connection to host:%s, reconnecting", host)
+
     def __str__(self):
         return json.dumps(self.get_headers())
 
@@ -110,35 +252,86 @@ class DbxAPI(object):
     # Get Dropbox content of path.
     def list_folder(self, path, cursor=None):
         # If cursor has been provided
-        request = DbxRequest()
         if cursor is not None:
-            args = {
-                "cursor": cursor
-            }
-            result = request.post('https://api.dropboxapi.com/2/files/list_folder/continue', body=json.dumps(args))
-            return result.get_dbx_object()
+            return self.list_folder_continue(cursor)
 
         # Check if path is file, in case of file return file metadata
+        item = self.get_folder_item(path)
+        if item.is_folder:
+            entries = []
+            for page in self.list_folder_pages(path):
+                if page.is_error:
+                    item.update(page.object)
+                    return item
+                entries.extend(page.entries)
+            item.update({
+                "entries": entries,
+                "cursor": page.cursor,
+                "has_more": False
+            })
+        return item
+
+    # Returns metadata of path, root folder has no metadata in API2
+    def get_folder_item(self, path):
         if path != '/':
-            item = self.get_metadata(path)
-        else:
-            item = DbxObject(data={".tag":"folder"})
+            return self.get_metadata(path)
+        return DbxObject(data={".tag": "folder", "path_display": "/", "path_lower": "/"})
+
+    # Generator of list_folder result pages, follows cursor as long as has_more is set
+    def list_folder_pages(self, path, recursive=False):
+        args = {
             # API2 requirements
-            path = ""
+            "path": path if path != '/' else "",
+            "include_media_info": True,
+            "include_deleted": False,
+            "include_has_explicit_shared_members": False,
+            "recursive": recursive
+        }
+        request = DbxRequest()
+        result = request.post('https://api.dropboxapi.com/2/files/list_folder', body=json.dumps(args))
+        page = result.get_dbx_object()
+        yield page
+        while not page.is_error and page.has_more:
+            logger.debug("Fetching next list_folder page for:%s", path)
+            page = self.list_folder_continue(page.cursor)
+            yield page
 
-        if item.is_folder:
-            args = {
-                "path": path,
-                "include_media_info": True,
-                "include_deleted": False,
-                "include_has_explicit_shared_members": False,
-                "recursive": False
-            }
-            result = request.post('https://api.dropboxapi.com/2/files/list_folder', body=json.dumps(args))
-            item.update(result.get_dbx_object().object)
-        return item
+    # Cursor of current state of path, used to follow changes
+    def get_latest_cursor(self, path, recursive=False):
+        args = {
+            "path": path if path != '/' else "",
+            "include_media_info": True,
+            "include_deleted": False,
+            "include_has_explicit_shared_members": False,
+            "recursive": recursive
+        }
+        request = DbxRequest()
+        result = request.post('https://api.dropboxapi.com/2/files/list_folder/get_latest_cursor',
+                              body=json.dumps(args))
+        return result.get_dbx_object()
+
+    # Wait for changes since cursor, request does not carry authorization
+    def longpoll(self, cursor, timeout=30, pool=None):
+        args = {
+            "cursor": cursor,
+            "timeout": timeout
+        }
+        request = DbxRequest(authorization=False)
+        if pool is not None:
+            request.pool = pool
+        result = request.post('https://notify.dropboxapi.com/2/files/list_folder/longpoll', body=json.dumps(args))
+        return result.get_dbx_object()
+
+    def list_folder_continue(self, cursor):
+        args = {
+            "cursor": cursor
+        }
+        request = DbxRequest()
+        result = request.post('https://api.dropboxapi.com/2/files/list_folder/continue', body=json.dumps(args))
+        return result.get_dbx_object()
 
-    def download(self, path, seek=False):
+    # Download file, whole content from seek offset or length bytes only if length is given
+    def download(self, path, seek=False, length=None):
         url = "https://content.dropboxapi.com/2/files/download"
         args = {
             "path": path
@@ -146,7 +339,9 @@ class DbxAPI(object):
 
         # add range retrieval request
         extra_params = {}
-        if seek != False:
+        if length is not None:
+            extra_params = {'Range': 'bytes=%s-%s' % (seek or 0, (seek or 0) + length - 1)}
+        elif seek != False:
             extra_params = {'Range': 'bytes=' + str(seek) + '-'}
 
         request = DbxRequest(binary=True, dbx_arg=args, extra_params=extra_params, content_type=None, user_agent=None)
@@ -175,39 +370,67 @@ class DbxAPI(object):
         result = request.post(url, body=json.dumps(args))
         return result.get_dbx_object()
 
-    # Upload file
-    def upload(self, upload_file):
+    # Upload spooled data of upload_file, or chunk taken from it, as next part of the upload session
+    # Closed session takes no more data and can be committed by finish_batch
+    def upload(self, upload_file, chunk=None, close=False):
+        body = upload_file.view() if chunk is None else memoryview(chunk)
         # Start new upload session
         if not upload_file.is_session_open:
             logger.debug("Upload session not started...starting")
-            url = "https://content.dropboxapi.com/2/files/upload_session/start"
-            args = {
-                'close': False
-            }
+            upload_file.upload_status = self.start_upload(body, close=close)
+            upload_file.update_session_id()
         else:
             logger.debug("Upload session started, session_id:%s", upload_file.session_id)
-            # Session is opened
-            url = "https://content.dropboxapi.com/2/files/upload_session/append_v2"
-            args = {
-                'cursor': {
-                    'session_id': upload_file.session_id,
-                    'offset': upload_file.offset
-                },
-                'close': False
-            }
-        request = DbxRequest(binary=True, dbx_arg=args)
-        result = request.post(url, body=upload_file.buf)
+            upload_file.upload_status = self.append_upload(upload_file.session_id, upload_file.offset, body, close)
+
         # if upload ok flush buffer
-        if not upload_file.is_session_open:
-            upload_file.upload_status = result.get_dbx_object()
-            upload_file.update_session_id()
-        else:
-            # After append2 we do not expect response if no error
-            upload_file.upload_status = result.get_result_if_error()
+        if not upload_file.upload_status.is_error:
+            if chunk is None:
+                upload_file.flush()
+            else:
+                upload_file.offset += len(body)
+
+        logger.debug("Upload result:%s", upload_file.upload_status)
+        return upload_file
+
+    # Start upload session, data of concurrent sessions is sent by append_upload only
+    def start_upload(self, body="", concurrent=False, close=False):
+        url = "https://content.dropboxapi.com/2/files/upload_session/start"
+        args = {
+            'close': close
+        }
+        if concurrent:
+            args['session_type'] = 'concurrent'
+        request = DbxRequest(binary=True, dbx_arg=args)
+        result = request.post(url, body=body)
+        return result.get_dbx_object()
 
+    # Append data at offset of upload session, the last append of concurrent session has to close it
+    def append_upload(self, session_id, offset, body, close=False):
+        url = "https://content.dropboxapi.com/2/files/upload_session/append_v2"
+        args = {
+            'cursor': {
+                'session_id': session_id,
+                'offset': offset
+            },
+            'close': close
+        }
+        request = DbxRequest(binary=True, dbx_arg=args)
+        result = request.post(url, body=body)
+        # After append2 we do not expect response if no error
+        return result.get_result_if_error()
+
+    # Upload whole spooled content of upload_file and commit it in one request, for files smaller than a chunk
+    def upload_single(self, upload_file):
+        url = "https://content.dropboxapi.com/2/files/upload"
+        args = {
+            "path": upload_file.path
+        }
+        request = DbxRequest(binary=True, dbx_arg=args)
+        result = request.post(url, body=upload_file.view())
+        upload_file.result = upload_file.upload_status = result.get_dbx_object()
         if not upload_file.upload_status.is_error:
             upload_file.flush()
-
         logger.debug("Upload result:%s", upload_file.upload_status)
         return upload_file
 
@@ -228,6 +451,34 @@ class DbxAPI(object):
         upload_file.result = result.get_dbx_object()
         return upload_file
 
+    # Commit closed upload sessions of several files, result is complete or has async_job_id to be checked
+    def finish_batch(self, upload_files):
+        url = "https://api.dropboxapi.com/2/files/upload_session/finish_batch"
+        args = {
+            "entries": [{
+                "cursor": {
+                    "session_id": upload_file.session_id,
+                    "offset": upload_file.offset
+                },
+                "commit": {
+                    "path": upload_file.path
+                }
+            } for upload_file in upload_files]
+        }
+        request = DbxRequest()
+        result = request.post(url, body=json.dumps(args))
+        return result.get_dbx_object()
+
+    # Status of finish_batch job, in_progress until entries are complete
+    def finish_batch_check(self, async_job_id):
+        url = "https://api.dropboxapi.com/2/files/upload_session/finish_batch/check"
+        args = {
+            "async_job_id": async_job_id
+        }
+        request = DbxRequest()
+        result = request.post(url, body=json.dumps(args))
+        return result.get_dbx_object()
+
     # Rename a Dropbox file/directory object.
     def move(self, old, new):
         url = "https://api.dropboxapi.com/2/files/move"
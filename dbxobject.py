@@ -1,11 +1,29 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import json
 import os
+import struct
+import threading
+from collections import namedtuple
 from datetime import datetime
-from time import time, mktime
+from time import time, mktime, strptime
 
 from dateutil import parser
 
+DBX_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+# Convert Dropbox time string to int timestamp
+def parse_time(value, default=None):
+    if value is None:
+        return default
+    try:
+        # Fast path for API format, same time tuple as dateutil gives for UTC
+        t = strptime(value, DBX_TIME_FORMAT)[:8] + (0,)
+    except ValueError:
+        t = parser.parse(value).timetuple()
+    return int(mktime(t))
+
 
 class DbxResponse(object):
     def __init__(self, response, api_result=None, error_code=0, error_summary=None):
@@ -78,21 +96,19 @@ class DbxObject(object):
         self.cache_time = 3600
         self.file_handle = file_handle
         self.object = {}
+        self._index = None
         self.update(data=data)
         self._created = int(time())
 
     def update(self, data):
         self.object.update(data)
+        self._index = None
 
     # Metody prywatne
 
     # Get entry time and convert it to int
     def _get_time(self, key):
-        now = int(time())
-        if self._has_key(key):
-            t = parser.parse(self._get_key(key))
-            now = int(mktime(t.timetuple()))
-        return now
+        return parse_time(self._get_key(key), int(time()))
 
     def _has_key(self, key):
         return self.object is not None and key in self.object
@@ -199,6 +215,14 @@ class DbxObject(object):
     def path(self):
         return self._get_key('path_display')
 
+    @property
+    def path_lower(self):
+        return self._get_key('path_lower')
+
+    @property
+    def rev(self):
+        return self._get_key('rev')
+
     @property
     def basename(self):
         return os.path.basename(self.path)
@@ -222,11 +246,19 @@ class DbxObject(object):
             return size
         return 0
 
+    # Compact metadata record of this object
+    def to_entry(self):
+        return DbxEntry.from_dict(self.object)
+
+    # Index of entries by lowercase path, Dropbox paths are case-insensitive
+    def _get_index(self):
+        if self._index is None:
+            self._index = dict((x.get('path_lower', x.get('path_display', '')).lower(), x) for x in self.entries)
+        return self._index
+
     def get_entry(self, path):
-        for tmp in self.sub_items:
-            if tmp.path == path:
-                return tmp
-        return None
+        data = self._get_index().get(path.lower())
+        return DbxObject(data) if data is not None else None
 
     def has_entry(self, path):
         if self.get_entry(path) is not None:
@@ -234,6 +266,58 @@ class DbxObject(object):
         return False
 
 
+class DbxEntry(namedtuple('DbxEntry', 'tag path path_lower id size rev content_hash server_modified client_modified')):
+    """
+    Compact immutable metadata record, built once when listing is ingested.
+    Modification times are kept as int timestamps.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, data):
+        now = int(time())
+        return cls(
+            tag=data.get('.tag'),
+            path=data.get('path_display'),
+            path_lower=data.get('path_lower'),
+            id=data.get('id'),
+            size=data.get('size', 0),
+            rev=data.get('rev'),
+            content_hash=data.get('content_hash'),
+            server_modified=parse_time(data.get('server_modified'), now),
+            client_modified=parse_time(data.get('client_modified'), now))
+
+    @property
+    def is_folder(self):
+        return self.tag == 'folder'
+
+    @property
+    def is_file(self):
+        return self.tag == 'file'
+
+    @property
+    def is_fs_entry(self):
+        return self.is_folder or self.is_file
+
+    @property
+    def is_deleted(self):
+        return self.tag == 'deleted'
+
+    @property
+    def basename(self):
+        return os.path.basename(self.path)
+
+    @property
+    def parent_path(self):
+        return os.path.dirname(self.path)
+
+    # Stable inode number derived from Dropbox id, survives renames and remounts
+    @property
+    def inode(self):
+        key = self.id or self.path_lower or ''
+        return max(struct.unpack('<Q', hashlib.md5(key.encode('utf-8')).digest()[:8])[0] >> 1, 2)
+
+
 class FileHandle(object):
 
     write_cache_size = 4096
@@ -241,12 +325,20 @@ class FileHandle(object):
     def __init__(self, fsentry, mode='r'):
         self.mode = mode
         self.run = False
-        self.lock = False
+        # Serializes operations on the handle
+        self.lock = threading.Lock()
         self.fh = False
         self.offset = 0
         self.fsentry = fsentry
-        self._buf = ''
+        # Write-back spool, appended in place and sent as one chunk per upload request
+        self._buf = bytearray()
         self.session_id = ''
+        # Read-ahead state of handle opened for reading
+        self.readahead = None
+        # Background Uploader of handle opened for writing
+        self.uploader = None
+        # Cache path pinned while the handle is open
+        self.pinned = None
 
     @property
     def is_running(self):
@@ -254,7 +346,7 @@ class FileHandle(object):
 
     @property
     def is_locked(self):
-        return self.lock == True
+        return self.lock.locked()
 
     def read(self, length):
         try:
@@ -283,12 +375,25 @@ class FileHandle(object):
 
     @buf.setter
     def buf(self, buf):
-        self._buf += buf
+        self._buf.extend(buf)
+
+    # Spooled data without copy, views are valid until flush
+    def view(self, start=0, stop=None):
+        return memoryview(self._buf)[start:stop]
+
+    # Detach up to size bytes of spooled data for upload, the offset advances once the chunk is uploaded
+    def take(self, size=None):
+        if size is None or size >= len(self._buf):
+            chunk, self._buf = self._buf, bytearray()
+        else:
+            chunk, self._buf = self._buf[:size], self._buf[size:]
+        return chunk
 
     # flush is called to empty buffer
     def flush(self):
         self.offset += self.buf_size
-        self._buf = ""
+        # New spool, views exported to requests keep the old one alive
+        self._buf = bytearray()
 
     @property
     def buf_size(self):
@@ -317,7 +422,7 @@ def get_new_file_instance(path):
     return DbxObject(data={
         'size': 0,
         'path_display': path,
-        'path_lower': path,
+        'path_lower': path.lower(),
         '.tag': 'file',
         'client_modified': now,
         'server_modified': now
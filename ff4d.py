@@ -20,20 +20,27 @@
 from __future__ import with_statement
 
 import argparse
+import fnmatch
 import json
 import logging
 import os
 import pwd
 import sys
+import threading
 import traceback
+from collections import OrderedDict
 from errno import *
 from stat import S_IFDIR, S_IFREG
 from time import time, sleep
 
-from cache import FileHandleCache, ItemCache
-from dbxapi import DbxRequest, DbxAPI
+from cache import BlockCache, FileHandleCache, ItemCache, SingleFlight, cache_key
+from dbxapi import ConnectionPool, DbxRequest, DbxAPI
 from dbxobject import FileHandle
 from fuse import FUSE, FuseOSError, Operations
+from reader import BlockReader, ReadAhead
+from store import BlockStore, MetadataStore, StoreSync
+from uploader import CommitBatch, Uploader
+from watcher import ChangeWatcher, prefetch_tree
 
 logger = logging.getLogger(__name__)
 rawlogger = logging.getLogger(__name__)
@@ -43,18 +50,111 @@ rawlogger = logging.getLogger(__name__)
 # Class: FUSE Dropbox operations #
 ##################################
 class Dropbox(Operations):
+    """
+    FUSE operations, mounted with raw_fi so that open can control kernel page cache of the handle.
+    """
     root_folder = None
+    # Number of remembered revisions of opened files
+    max_revs = 16384
 
-    def __init__(self, dbxApi, root_folder=None):
+    def __init__(self, dbxApi, root_folder=None, store=None, watch=False, prefetch=None, use_ino=False,
+                 block_store=None, direct_io=None):
         self.ar = dbxApi
         self.cache = ItemCache()
         self.openfh = FileHandleCache()
+        self.blocks = BlockCache()
+        # API requests in flight, concurrent misses of the same path wait for one result
+        self.flights = SingleFlight()
+        self.reader = BlockReader(dbxApi, self.blocks, block_store, self.flights)
+        # Small files closed in quick succession are committed together
+        self.commits = CommitBatch(dbxApi)
         self.root_folder = root_folder
+        # Optional persistent metadata store
+        self.sync = StoreSync(dbxApi, self.cache, store) if store is not None else None
+        # Optional watcher applying remote changes to the cache
+        self.watcher = ChangeWatcher(dbxApi, self.cache, self.dbx_root_path(u'/')) if watch else None
+        # Paths loaded with recursive listing at mount time
+        self.prefetch_paths = prefetch
+        # Inode numbers derived from Dropbox ids, FUSE has to be mounted with use_ino
+        self.use_ino = use_ino
+        # Path patterns of files opened with direct_io, e.g. files known to change remotely
+        self.direct_io = direct_io or []
+        # Revisions of opened files by path, used to keep kernel page cache
+        self._revs = OrderedDict()
+        self._revs_lock = threading.Lock()
+        # Files are owned by user running ff4d
+        user = pwd.getpwuid(os.getuid())
+        self.uid = user.pw_uid
+        self.gid = user.pw_gid
+
+    # Background threads have to be started after FUSE has daemonized.
+    def init(self, path):
+        if self.sync is not None:
+            self.sync.start()
+        self.reader.start()
+        self.commits.start()
+        if self.prefetch_paths:
+            prefetcher = threading.Thread(target=self._prefetch_tree, name='Prefetch')
+            prefetcher.daemon = True
+            prefetcher.start()
+        elif self.watcher is not None:
+            self.watcher.start()
+
+    # Prefetch all paths, watcher is started afterwards and follows changes from cursor of the mounted root
+    def _prefetch_tree(self):
+        try:
+            for tmp in self.prefetch_paths:
+                path = self.dbx_root_path(tmp)
+                try:
+                    cursor = self.prefetch(path)
+                except Exception as e:
+                    logger.error('Could not prefetch: %s', path)
+                    logger.debug(e, exc_info=True)
+                    continue
+                if self.watcher is not None and path == self.watcher.path:
+                    self.watcher.cursor = cursor
+        finally:
+            if self.watcher is not None:
+                self.watcher.start()
+
+    # Cache whole subtree of path with recursive listing, returns cursor of the listing
+    def prefetch(self, path):
+        return prefetch_tree(self.ar, self.cache, path)
+
+    # Restore folder listings of path from persistent store, returns True if path is cached afterwards
+    def _restore(self, path):
+        if self.sync is None:
+            return False
+        parent = self.cache.get(os.path.dirname(path))
+        if parent is None or not parent.has_entries:
+            self.sync.restore(os.path.dirname(path))
+        item = self.cache.get(path)
+        if item is not None and item.is_folder and not item.has_entries:
+            self.sync.restore(path)
+        return self.cache.is_in_cache(path)
+
+    # Cache list_folder result, complete listing is saved to persistent store
+    def _cache_listing(self, item, started):
+        cached = self.cache.add(item, started)
+        if self.sync is not None and cached.has_entries:
+            self.sync.save(cached, item.cursor)
+        return cached
+
+    # Fetch listing of path, concurrent requests of the same path share one API call.
+    # Returns (started, item), started is time the shared request has been made.
+    def _fetch_listing(self, path):
+        return self.flights.do(('list_folder', cache_key(path)), self._list_folder_since, path)
+
+    def _list_folder_since(self, path):
+        started = time()
+        return started, self.ar.list_folder(path)
 
     # Get metadata for a file or folder from the Dropbox API or local cache.
     # Deep do sprawdzenia
     def getDropboxMetadata(self, path, deep=False):
         logger.debug('Get metadata deep:%s, path:%s', deep, path)
+        # File closed recently exists once its batch is committed
+        self._wait_commit(path)
         item = self.cache.get(path)
         if item is not None:
             logger.debug('Found cached metadata for: %s', path)
@@ -62,28 +162,31 @@ class Dropbox(Operations):
             if (item.is_folder and item.is_expired) or (deep == True and not item.has_entries):
                 # Set temporary hash value for directory non-deep cache entry.
                 logger.debug('Metadata directory deepcheck deep:%s, expired:%s, path:%s', deep, item.is_expired, path)
-                self.cache.remove(path)
                 # Get fresh data
-                item = self.ar.list_folder(path)
+                started, item = self._fetch_listing(path)
                 if item.is_error or item.is_deleted:
+                    self.cache.remove(path)
                     logging.exception('Error occured(%s) or entry has been deleted(%s) for %s.', item.is_error,
                                       item.is_deleted, path)
                     return False
                 logger.debug('Updating local cache for %s', path)
                 # Cache new data.
-                self.cache.add(item)
+                item = self._cache_listing(item, started)
             return item
 
         # No cached data found, do an Dropbox API request to fetch the metadata.
         logger.debug('No cached metadata for:%s', path)
+        # Listing stored on disk by previous mount is served until it is revalidated
+        if self._restore(path):
+            return self.getDropboxMetadata(path, deep)
         try:
             # If the parent path already exists, this path (file/dir) does not exist.
             baseEntry = self.cache.get(os.path.dirname(path))
-            if baseEntry is not None and baseEntry.is_folder:
+            if baseEntry is not None and baseEntry.has_entries and not baseEntry.is_expired:
                 logger.debug('Basepath %s exists in cache for:%s', baseEntry.path, path)
                 return False
             # Get item metadata from dropbox
-            item = self.ar.list_folder(path)
+            started, item = self._fetch_listing(path)
             logger.debug("List folder for path %s, Item %s:", path, item)
             # If path does not exists error info is returned or file/older has been deleted
             if item.is_error or item.is_deleted:
@@ -94,8 +197,7 @@ class Dropbox(Operations):
             logger.debug(e, exc_info=True)
             raise FuseOSError(EREMOTEIO)
         # Cache metadata if user wants to use the cache.
-        self.cache.add(item)
-        return item
+        return self._cache_listing(item, started)
 
     #########################
     # Filesystem functions. #
@@ -112,21 +214,23 @@ class Dropbox(Operations):
         if item.is_error:
             logger.error('Could not create folder: %s ', item.error_summary)
             raise FuseOSError(EIO)
-        # Remove outdated parent folder data from cache.
-        self.cache.remove(item.parent_path)
+        # New folder is added to parent folder content.
+        self.cache.add(item)
         return 0
 
     # Remove a directory.
     def rmdir(self, path):
         path = self.dbx_root_path(path)
         logger.debug('Called: rmdir() - Path:%s', path)
+        self._wait_commit(path)
         item = self.ar.delete(path)
         if item.is_error:
             logger.error('Could not delete folder:%s', item.error_summary)
             raise FuseOSError(EIO)
-        # Remove outdated data from cache.
-        self.cache.remove(item.path)
-        self.cache.remove(item.parent_path)
+        # Remove deleted subtree from cache.
+        self.cache.delete(item.path)
+        if self.sync is not None:
+            self.sync.delete(item.path)
         return 0
 
     # Remove a file.
@@ -139,17 +243,23 @@ class Dropbox(Operations):
         old = self.dbx_root_path(old)
         new = self.dbx_root_path(new)
         logger.debug('Called: rename() - Old:%s New:%s', old, new)
+        self._wait_commit(old)
+        self._wait_commit(new)
         item = self.ar.move(old, new)
         if item.is_error:
             logger.error('Could not rename object: %s', item.error_summary)
             raise FuseOSError(EIO)
-        # Remove outdated data from cache.
-        self.cache.remove(old)
-        self.cache.remove(os.path.basename(new))
+        # Move cached subtree to new location.
+        self.cache.move(old, item)
+        if self.sync is not None:
+            self.sync.delete(old)
         return 0
 
     # Open a filehandle.
-    def open(self, path, flags):
+    # Kernel keeps cached pages of file if the same revision has been opened before.
+    def open(self, path, fi):
+        flags = fi.flags
+        direct_io = self._is_direct_io(path)
         path = self.dbx_root_path(path)
         logger.debug('Called: open() - Path:%s Flags:%s', path, flags)
         # Validate flags.
@@ -161,103 +271,167 @@ class Dropbox(Operations):
             logger.debug('Path does not exist:%s', path)
             raise FuseOSError(EOPNOTSUPP)
 
-        fh = self.openfh.new_fh(mode='r', item=meta)
-        logger.debug('Returning unique filehandle: %s', fh)
-        return fh
+        # Handle keeps metadata of opened revision
+        fh = self.openfh.new_fh(mode='r', item=meta.entry)
+        if fh == False:
+            logger.error('Too many open files, could not open: %s', path)
+            raise FuseOSError(ENFILE)
+        remote_file = self.openfh.get_fh(fh)
+        remote_file.readahead = ReadAhead()
+        # Handle unpins the path it pinned, even if the file is renamed meanwhile
+        remote_file.pinned = path
+        self.cache.pin(path)
+        fi.fh = fh
+        if direct_io:
+            fi.direct_io = 1
+        else:
+            fi.keep_cache = int(self._opened_rev(meta.entry))
+        logger.debug('Returning unique filehandle: %s, keep_cache: %s', fh, fi.keep_cache)
+        return 0
+
+    # Files matching direct_io patterns bypass kernel page cache
+    def _is_direct_io(self, path):
+        return any(fnmatch.fnmatch(path, x) for x in self.direct_io)
+
+    # Remember revision of opened file, returns True if the same revision has been opened before
+    def _opened_rev(self, entry):
+        if not entry.rev:
+            return False
+        with self._revs_lock:
+            rev = self._revs.pop(entry.path_lower, None)
+            self._revs[entry.path_lower] = entry.rev
+            if len(self._revs) > self.max_revs:
+                self._revs.popitem(last=False)
+        return rev == entry.rev
 
     # Create a file.
-    def create(self, path, mode):
+    def create(self, path, mode, fi):
         path = self.dbx_root_path(path)
         logger.debug('Called: create() - Path:%s  Mode:%s', path, mode)
         fh = self.openfh.new_fh(path=path, mode='w')
-        self.cache.add(self.openfh.get_fh(fh).fsentry)
+        if fh == False:
+            logger.error('Too many open files, could not create: %s', path)
+            raise FuseOSError(ENFILE)
+        remote_file = self.openfh.get_fh(fh)
+        self.cache.add(remote_file.fsentry)
+        remote_file.pinned = path
+        self.cache.pin(path)
+        fi.fh = fh
         logger.debug('Returning unique filehandle: %s', fh)
-        return fh
+        return 0
 
     # Read data from a remote filehandle.
-    def read(self, path, length, offset, fh):
+    # Content is fetched in blocks by range requests, sequential reads are prefetched in background.
+    def read(self, path, length, offset, fi):
+        fh = fi.fh
         path = self.dbx_root_path(path)
-        # Get filehandle
         remote_file = self.openfh.get_fh(fh)
-        # Wait while this function is not threadable.
-        while remote_file.is_locked:
-            pass
-
+        if remote_file == False:
+            raise FuseOSError(EIO)
         logger.debug('Called: read() - Path:%s Length: %s Offset: %s  FH: %s', path, length, offset, fh)
-        logger.debug('Expected offset: %s', remote_file.offset)
-
-        if remote_file.fh == False or remote_file.offset != offset:
-            # Remote file has not been eopened yet or eoffset is differ
-            item = self.ar.download(path, offset)
-            if item.is_error:
-                logger.error('Could not open remote file: %s, error:%s', path, item.error_summary)
-                raise FuseOSError(EIO)
-            remote_file.fh = item.file_handle
-
-        rbytes = None
         try:
-            rbytes = remote_file.fh.read(length)
-            remote_file.offset = offset + len(rbytes)
+            # Handle lock guards read-ahead state, reads of other handles run in parallel
+            with remote_file.lock:
+                rbytes = self.reader.read(remote_file.fsentry, offset, length, remote_file.readahead)
         except Exception as e:
-            logger.error('Could not read data from remotefile')
-            logger.error(e, exc_info=True)
+            logger.error('Could not read data from remotefile: %s', path)
+            logger.debug(e, exc_info=True)
             raise FuseOSError(EIO)
-
-        logger.debug('Read bytes from remote source: %s', len(rbytes))
-        remote_file.lock = False
-        # remote_file.offset = offset + len(rbytes)
+        logger.debug('Read bytes: %s', len(rbytes))
         return rbytes
 
+    # Read data straight into FUSE buffer, used when mounted with raw reads.
+    def readinto(self, path, buf, offset, fi):
+        fh = fi.fh
+        path = self.dbx_root_path(path)
+        remote_file = self.openfh.get_fh(fh)
+        if remote_file == False:
+            raise FuseOSError(EIO)
+        logger.debug('Called: readinto() - Path:%s Length: %s Offset: %s  FH: %s', path, len(buf), offset, fh)
+        try:
+            with remote_file.lock:
+                return self.reader.readinto(remote_file.fsentry, buf, offset, remote_file.readahead)
+        except Exception as e:
+            logger.error('Could not read data from remotefile: %s', path)
+            logger.debug(e, exc_info=True)
+            raise FuseOSError(EIO)
+
     # Write data to a filehandle.
-    def write(self, path, buf, offset, fh):
+    def write(self, path, buf, offset, fi):
+        fh = fi.fh
         path = self.dbx_root_path(path)
         logger.debug('Called: write() - Path: %s Offset:%s FH:%s', path, offset, fh)
         logger.debug('Buffer size %s', len(buf))
         remote_file = self.openfh.get_fh(fh)
         if remote_file == False:
             raise FuseOSError(EIO)
-        remote_file.buf = buf
-        # Check for the beginning of the file.
-        if remote_file.is_cache_size_exceeded:
-            if remote_file.is_session_open:
-                logger.debug('Cache exceeds configured write_cache. Uploading...')
+        with remote_file.lock:
+            remote_file.buf = buf
+            # Check for the beginning of the file.
+            if remote_file.is_cache_size_exceeded:
+                logger.debug('Cache exceeds configured write_cache. Queueing chunk for upload...')
+                # Chunk is uploaded in background while the next one is filling
+                if remote_file.uploader is None:
+                    remote_file.uploader = Uploader(self.ar, remote_file)
+                try:
+                    # Chunks are cut at write_cache_size, concurrent sessions need multiples of 4 MB
+                    while remote_file.is_cache_size_exceeded:
+                        remote_file.uploader.put(remote_file.take(remote_file.write_cache_size))
+                except IOError as e:
+                    logger.error('Could not write to remote file: %s', path)
+                    logger.debug(e, exc_info=True)
+                    raise FuseOSError(EIO)
             else:
-                logger.debug('Uploading first chunk to Dropbox...')
-            result = self.ar.upload(remote_file)
-            if result.upload_status.is_error:
-                logger.exception('Could not write to remote file: %s', path)
-                raise FuseOSError(EIO)
-        else:
-            logger.debug('Buffer does not exceed configured write_cache. Caching...')
+                logger.debug('Buffer does not exceed configured write_cache. Caching...')
         # return size of written or cached data
         return len(buf)
 
     # Release (close) a filehandle.
-    def release(self, path, fh):
+    def release(self, path, fi):
+        fh = fi.fh
         path = self.dbx_root_path(path)
         logger.debug('Called: release() - Path:%s FH%s', path, fh)
         remote_file = self.openfh.get_fh(fh)
         if remote_file == False:
             raise FuseOSError(EIO)
-        #Release handle whatever happens handle is released
-        logger.debug('Released filehandle: ' + str(fh))
-        self.openfh.release_fh(fh)
-        if (remote_file.mode == 'w' and remote_file.buf_size > 0) or remote_file.is_session_open:
-            #Remove from cache
-            self.cache.remove(remote_file.path)
-            try:
-                if remote_file.buf_size > 0:
-                    result = self.ar.upload(remote_file)
-                    if result.upload_status.is_error:
-                        raise Exception()
-                result = self.ar.commit_upload(remote_file)
-                if result.upload_status.is_error:
-                    raise Exception()
-            except Exception as e:
+        # Wait for writes in progress, no other operation can use the handle afterwards
+        with remote_file.lock:
+            #Release handle whatever happens handle is released
+            logger.debug('Released filehandle: ' + str(fh))
+            self.openfh.release_fh(fh)
+            if remote_file.readahead is not None:
+                remote_file.readahead.cancel()
+        try:
+            if (remote_file.mode == 'w' and remote_file.buf_size > 0) or remote_file.uploader is not None:
+                #Remove from cache
                 self.cache.remove(remote_file.path)
-                logger.exception('Could not write to remote file: %s', path)
-                raise FuseOSError(EIO)
-            logger.debug('Finishing upload to Dropbox')
+                try:
+                    if remote_file.uploader is None and self.commits.window > 0:
+                        # Session is closed by the request carrying whole content and committed in batch
+                        result = self.ar.upload(remote_file, close=True)
+                        if result.upload_status.is_error:
+                            raise Exception()
+                        self.commits.add(remote_file)
+                    elif remote_file.uploader is None:
+                        # File fits in one chunk, uploaded and committed by single request
+                        result = self.ar.upload_single(remote_file)
+                        if result.upload_status.is_error:
+                            raise Exception()
+                    else:
+                        # Last chunk goes through the uploader, waits for chunks still being uploaded in background
+                        remote_file.uploader.close(remote_file.take())
+                        result = self.ar.commit_upload(remote_file)
+                        if result.upload_status.is_error:
+                            raise Exception()
+                except Exception as e:
+                    self.cache.remove(remote_file.path)
+                    logger.exception('Could not write to remote file: %s', path)
+                    raise FuseOSError(EIO)
+                logger.debug('Finishing upload to Dropbox')
+        finally:
+            # Handle is closed and upload finished, path can be evicted from cache
+            if remote_file.pinned is not None:
+                self.cache.unpin(remote_file.pinned)
         # Remove outdated data from cache if handle was opened for writing.
         return 0
 
@@ -271,25 +445,53 @@ class Dropbox(Operations):
     def readdir(self, path, fh):
         path = self.dbx_root_path(path)
         logger.debug('Called: readdir() - Path: ' + path)
+        # Files closed recently are listed once their batch is committed
+        self.commits.wait_folder(path)
 
-        # Fetch folder informations.
-        fusefolder = ['.', '..']
-
-        metadata = self.getDropboxMetadata(path, True)
-        if metadata == False:
-            raise FuseOSError(ENOENT)
-
-        # Loop through the Dropbox API reply to build fuse structure.
-        for item in metadata.sub_items:
-            # Append entry to fuse foldercontent.
-            folderitem = item.basename
-            fusefolder.append(folderitem)
+        item = self.cache.get(path)
+        if (item is None or not item.has_entries) and self.sync is not None and self.sync.restore(path):
+            item = self.cache.get(path)
+        if item is not None and item.has_entries and not item.is_expired:
+            logger.debug('Found cached folder content for: %s', path)
+            sub_items = item.sub_items
+        else:
+            sub_items = self._list_folder(path)
 
-        logger.debug("fusefolder:" + str(fusefolder))
+        yield '.'
+        yield '..'
+        # Entries are passed to fuse as each listing page arrives, attributes come straight from the listing.
+        for item in sub_items:
+            yield item.basename, self._attrs(item), 0
 
-        # Loop through the folder content.
-        for item in fusefolder:
-            yield item
+    # Fetch fresh folder metadata, returns generator of folder entries
+    def _list_folder(self, path):
+        try:
+            item = self.flights.do(('get_metadata', cache_key(path)), self.ar.get_folder_item, path)
+        except Exception as e:
+            logger.error('Could not fetch metadata for: %s', path)
+            logger.debug(e, exc_info=True)
+            raise FuseOSError(EREMOTEIO)
+        if item.is_error or item.is_deleted:
+            self.cache.remove(path)
+            raise FuseOSError(ENOENT)
+        folder = self.cache.add(item)
+        if not folder.is_folder:
+            return []
+        return self._list_folder_pages(folder, path)
+
+    # Sub entries are cached page by page, folder content is served from cache once the listing is complete.
+    def _list_folder_pages(self, folder, path):
+        started = time()
+        for page in self.ar.list_folder_pages(path):
+            if page.is_error:
+                logger.error('Could not list folder: %s, error:%s', path, page.error_summary)
+                raise FuseOSError(EIO)
+            logger.debug('Caching listing page of %s entries for: %s', len(page.entries), path)
+            for tmp in self.cache.add_page(folder, page):
+                yield tmp
+        self.cache.set_listed(folder, started)
+        if self.sync is not None:
+            self.sync.save(folder, page.cursor)
 
     # Get properties for a directory or file.
     def getattr(self, path, fh=None):
@@ -297,54 +499,74 @@ class Dropbox(Operations):
 
         logger.debug('Called: getattr() - Path:%s', path)
 
-        # Get userid and groupid for current user.
-        uid = pwd.getpwuid(os.getuid()).pw_uid
-        gid = pwd.getpwuid(os.getuid()).pw_gid
-
         # Check wether data exists for item.
         item = self.getDropboxMetadata(path)
         if item == False:
             logger.debug("Entry's metadata not found - Path:%s", path)
             raise FuseOSError(ENOENT)
 
-        now = int(time())
-        modified = int(item.server_modified)
+        properties = self._attrs(item)
+        logger.debug('Returning properties for:%s (%s)', path, properties)
+        return properties
 
-        if item.is_folder:
-            # Get st_nlink count for directory.
-            properties = dict(
-                st_mode=S_IFDIR | 0755,
-                st_size=item.size,
-                st_ctime=modified,
-                st_mtime=modified,
-                st_atime=now,
-                st_uid=uid,
-                st_gid=gid,
-                st_nlink=2
-            )
-            logger.debug(
-                'Returning properties for directory:%s (%s)', path, properties)
-            return properties
-
-        # Regular file
+    # Stat attributes of cached item, used by getattr and readdir
+    def _attrs(self, item):
+        modified = int(item.server_modified)
         properties = dict(
-            st_mode=S_IFREG | 0755,
             st_size=item.size,
             st_ctime=modified,
             st_mtime=modified,
-            st_atime=now,
-            st_uid=uid,
-            st_gid=gid,
-            st_nlink=1,
+            st_atime=int(time()),
+            st_uid=self.uid,
+            st_gid=self.gid
         )
-        logger.debug('Returning properties for file:%s (%s)', path, properties)
+        if item.is_folder:
+            properties.update(st_mode=S_IFDIR | 0755, st_nlink=2)
+        else:
+            # Regular file
+            properties.update(st_mode=S_IFREG | 0755, st_nlink=1)
+        if self.use_ino:
+            properties['st_ino'] = item.inode
         return properties
 
         # Flush filesystem cache. Always true in this case.
 
-    def fsync(self, path, fdatasync, fh):
+    # Cache statistics are exposed as extended attribute of mount root.
+    def getxattr(self, path, name, position=0):
+        if path == '/' and name == 'user.ff4d.cache':
+            return json.dumps(self.cache.stats())
+        if path == '/' and name == 'user.ff4d.blocks':
+            return json.dumps(self.reader.stats())
+        raise FuseOSError(ENODATA)
+
+    def listxattr(self, path):
+        if path == '/':
+            return ['user.ff4d.cache', 'user.ff4d.blocks']
+        return []
+
+    def destroy(self, path):
+        self.commits.flush()
+        logger.info('Metadata cache statistics: %s', self.cache.stats())
+        logger.info('Block cache statistics: %s', self.reader.stats())
+        logger.info('Requests coalesced with ones in flight: %s', self.flights.shared)
+
+    def fsync(self, path, fdatasync, fi):
         path = self.dbx_root_path(path)
         logger.debug('Called: fsync() - Path:%s', path)
+        self._wait_commit(path)
+        return 0
+
+    def flush(self, path, fi):
+        path = self.dbx_root_path(path)
+        logger.debug('Called: flush() - Path:%s', path)
+        self._wait_commit(path)
+        return 0
+
+    # Wait for batched commit of path, failed commit is reported once
+    def _wait_commit(self, path):
+        if not self.commits.wait(path):
+            logger.error('Upload of %s could not be committed', path)
+            raise FuseOSError(EIO)
 
 
 ###########################
@@ -452,7 +674,22 @@ def getAccessToken():
 # Global variables.
 DbxAPI.access_token = False
 ItemCache.cache_time = 120  # Seconds
+ItemCache.max_entries = 0  # Unlimited
+ItemCache.max_bytes = 0  # Unlimited
 FileHandle.write_cache_size = 4194304  # Bytes
+Uploader.depth = 2  # Chunks
+Uploader.streams = 1  # Sequential appends
+CommitBatch.window = 0  # Seconds, disabled
+BlockCache.block_size = 4194304  # Bytes
+BlockCache.max_bytes = 67108864  # Bytes
+BlockCache.max_maps = 256  # Open block files
+BlockStore.max_bytes = 1073741824  # Bytes
+BlockReader.max_window = 8  # Blocks
+BlockReader.workers = 4
+BlockReader.parallel_size = 67108864  # Bytes
+FileHandleCache.max_handles = 0  # Unlimited
+ConnectionPool.pool_size = 8
+ConnectionPool.idle_timeout = 60  # Seconds
 use_cache = False
 allow_other = False
 allow_root = False
@@ -493,9 +730,71 @@ if __name__ == '__main__':
                         default=False)
     parser.add_argument('-ct', '--cache-time', help='Cache Dropbox data for X seconds (120 by default)', default=120,
                         type=int)
+    parser.add_argument('-w', '--watch',
+                        help='Follow remote changes and update cache in place, allows long --cache-time',
+                        action='store_true', default=False)
+    parser.add_argument('-pf', '--prefetch-tree',
+                        help='Load whole directory tree with recursive listing at mount time', action='store_true',
+                        default=False)
+    parser.add_argument('-pp', '--prefetch-path',
+                        help='Load directory tree of this path only, can be given multiple times (implies -pf)',
+                        action='append', default=None)
+    parser.add_argument('-to', '--attr-timeout',
+                        help='Let kernel cache file attributes and names for X seconds (1 by default)', default=1.0,
+                        type=float)
+    parser.add_argument('-in', '--use-ino', help='Use stable inode numbers derived from Dropbox ids',
+                        action='store_true', default=False)
+    parser.add_argument('-ce', '--cache-entries',
+                        help='Cache at most X metadata entries (unlimited by default)', default=0, type=int)
+    parser.add_argument('-cm', '--cache-memory',
+                        help='Cache at most X bytes of metadata, approximately (unlimited by default)', default=0,
+                        type=int)
+    parser.add_argument('-cd', '--cache-dir',
+                        help='Keep metadata and file content cache in this directory across mounts (disabled by default)',
+                        default=None)
+    parser.add_argument('-bs', '--block-size',
+                        help='Download files in blocks of X bytes (4 MB by default)', default=4194304, type=int)
+    parser.add_argument('-bm', '--block-memory',
+                        help='Cache at most X bytes of file blocks in memory (64 MB by default)', default=67108864,
+                        type=int)
+    parser.add_argument('-bf', '--block-files',
+                        help='Keep at most X stored block files mapped, each holds a file descriptor (256 by default)',
+                        default=256, type=int)
+    parser.add_argument('-ra', '--read-ahead',
+                        help='Prefetch up to X blocks ahead of sequential reads, 0 disables (8 by default), '
+                             'at most half of --block-memory per open file', default=8, type=int)
+    parser.add_argument('-rw', '--read-workers', help='Prefetch blocks with X threads (4 by default)', default=4,
+                        type=int)
+    parser.add_argument('-rp', '--read-parallel',
+                        help='Download files of X bytes and larger with --read-workers concurrent range requests '
+                             '(64 MB by default)', default=67108864, type=int)
+    parser.add_argument('-cs', '--cache-size',
+                        help='Keep at most X bytes of file content in --cache-dir, 0 disables (1 GB by default)',
+                        default=1073741824, type=int)
+    parser.add_argument('-rr', '--raw-read',
+                        help='Copy file content straight into kernel buffers, saves CPU at high throughput',
+                        action='store_true', default=False)
+    parser.add_argument('-di', '--direct-io',
+                        help='Bypass kernel page cache for files matching this pattern, e.g. "*.log", '
+                             'can be given multiple times', action='append', default=None)
     parser.add_argument('-wc', '--write-cache',
                         help='Cache X bytes (chunk size) before uploading to Dropbox (4 MB by default)',
                         default=4194304, type=int)
+    parser.add_argument('-uq', '--upload-queue',
+                        help='Let X chunks of --write-cache wait for background upload per file (2 by default)',
+                        default=2, type=int)
+    parser.add_argument('-us', '--upload-streams',
+                        help='Upload chunks of large files with X concurrent requests, needs --write-cache '
+                             'of a multiple of 4 MB (1 by default)', default=1, type=int)
+    parser.add_argument('-cb', '--commit-batch',
+                        help='Commit files smaller than --write-cache closed within X seconds together, '
+                             'e.g. 0.5 for copying many small files (disabled by default)', default=0, type=float)
+    parser.add_argument('-mh', '--max-handles', help='Allow at most X open files (unlimited by default)', default=0,
+                        type=int)
+    parser.add_argument('-ps', '--pool-size', help='Keep X idle HTTPS connections per Dropbox host (8 by default)',
+                        default=8, type=int)
+    parser.add_argument('-pt', '--pool-timeout',
+                        help='Close idle HTTPS connections after X seconds (60 by default)', default=60, type=int)
 
     #parser.add_argument('-rt','--root-dir', help='Dropbox directory to be mounted (Default /)',action='store_true',default='')
     parser.add_argument('-rt', '--root-dir', help='Dropbox app directory to be mounted (default is / app dir)', default='')
@@ -510,7 +809,22 @@ if __name__ == '__main__':
 
     # Set variables supplied by commandline.
     ItemCache.cache_time = args.cache_time
+    ItemCache.max_entries = args.cache_entries
+    ItemCache.max_bytes = args.cache_memory
     FileHandle.write_cache_size = args.write_cache
+    Uploader.depth = args.upload_queue
+    Uploader.streams = args.upload_streams
+    CommitBatch.window = args.commit_batch
+    BlockCache.block_size = args.block_size
+    BlockCache.max_bytes = args.block_memory
+    BlockCache.max_maps = args.block_files
+    BlockStore.max_bytes = args.cache_size
+    BlockReader.max_window = args.read_ahead
+    BlockReader.workers = args.read_workers
+    BlockReader.parallel_size = args.read_parallel
+    FileHandleCache.max_handles = args.max_handles
+    ConnectionPool.pool_size = args.pool_size
+    ConnectionPool.idle_timeout = args.pool_timeout
     allow_other = args.allow_other
     allow_root = args.allow_root
     debug = args.debug
@@ -521,9 +835,39 @@ if __name__ == '__main__':
     if ItemCache.cache_time < 0:
         logger.error('Only positive values for cache-time are possible')
         sys.exit(-1)
+    if ItemCache.max_entries < 0 or ItemCache.max_bytes < 0:
+        logger.error('Only positive values for cache-entries and cache-memory are possible')
+        sys.exit(-1)
     if FileHandle.write_cache_size < 4096:
         logger.error('The minimum write-cache has a size of 4096 Bytes')
         sys.exit(-1)
+    if Uploader.depth < 1:
+        logger.error('At least one chunk has to fit in upload-queue')
+        sys.exit(-1)
+    if Uploader.streams < 1 or (Uploader.streams > 1 and FileHandle.write_cache_size % 4194304):
+        logger.error('At least one upload-stream is needed, more streams need write-cache of a multiple of 4 MB')
+        sys.exit(-1)
+    if CommitBatch.window < 0:
+        logger.error('Only positive values for commit-batch are possible')
+        sys.exit(-1)
+    if BlockCache.block_size < 4096 or BlockCache.max_bytes < 0:
+        logger.error('The minimum block-size is 4096 Bytes, only positive values for block-memory are possible')
+        sys.exit(-1)
+    if BlockStore.max_bytes < 0:
+        logger.error('Only positive values for cache-size are possible')
+        sys.exit(-1)
+    if BlockCache.max_maps < 0:
+        logger.error('Only positive values for block-files are possible')
+        sys.exit(-1)
+    if BlockReader.max_window < 0 or BlockReader.workers < 1:
+        logger.error('Only positive values for read-ahead are possible, at least one read-worker is needed')
+        sys.exit(-1)
+    if FileHandleCache.max_handles < 0:
+        logger.error('Only positive values for max-handles are possible')
+        sys.exit(-1)
+    if ConnectionPool.pool_size < 0 or ConnectionPool.idle_timeout < 0:
+        logger.error('Only positive values for pool-size and pool-timeout are possible')
+        sys.exit(-1)
 
     FORMAT = "[%(filename)s:%(lineno)s - %(funcName)20s() ] %(message)s"
     if debug:
@@ -572,11 +916,39 @@ if __name__ == '__main__':
     account_info = ''
     try:
         account_info = ar.post('https://api.dropboxapi.com/2/users/get_current_account', body=json.dumps(None))
+        account_info = account_info.get_dbx_object()
     except Exception as e:
         logger.error('Could not talk to Dropbox API.')
         logger.error(e, exc_info=True)
         sys.exit(-1)
 
+    # Open persistent metadata store of this account.
+    store = None
+    if args.cache_dir is not None:
+        try:
+            store = MetadataStore(args.cache_dir, account_info.get_key('account_id'), root_dir)
+        except Exception as e:
+            logger.error('Could not open metadata store in: %s', args.cache_dir)
+            logger.error(e, exc_info=True)
+            sys.exit(-1)
+
+    # Open persistent content cache, blocks are shared by all accounts and mounts.
+    block_store = None
+    if args.cache_dir is not None and BlockStore.max_bytes > 0:
+        try:
+            block_store = BlockStore(args.cache_dir)
+        except Exception as e:
+            logger.error('Could not open content cache in: %s', args.cache_dir)
+            logger.error(e, exc_info=True)
+            sys.exit(-1)
+
+    # Paths of the mounted tree loaded at mount time.
+    prefetch = None
+    if args.prefetch_path:
+        prefetch = [x.decode('utf-8') for x in args.prefetch_path]
+    elif args.prefetch_tree:
+        prefetch = [u'/']
+
     # Save valid access token to configuration file.
     if args.access_token_temp == False:
         try:
@@ -598,8 +970,11 @@ if __name__ == '__main__':
     print "Starting FUSE..."
 
     try:
-        FUSE(Dropbox(DbxAPI(), root_folder=root_dir), mountpoint, foreground=args.background, debug=debug_fuse,
-             sync_read=True,
+        FUSE(Dropbox(DbxAPI(), root_folder=root_dir, store=store, watch=args.watch, prefetch=prefetch,
+                     use_ino=args.use_ino, block_store=block_store, direct_io=args.direct_io), mountpoint,
+             foreground=args.background, debug=debug_fuse,
+             raw_fi=True, sync_read=True, raw_read=args.raw_read, use_ino=args.use_ino, attr_timeout=args.attr_timeout,
+             entry_timeout=args.attr_timeout,
              allow_other=allow_other, allow_root=allow_root)
     except Exception as e:
         logger.error('Failed to start FUSE...')
@@ -420,17 +420,22 @@ class FUSE(object):
     )
 
     def __init__(self, operations, mountpoint, raw_fi=False, encoding='utf-8',
-                 **kwargs):
+                 raw_read=False, **kwargs):
 
         '''
         Setting raw_fi to True will cause FUSE to pass the fuse_file_info
         class as is to Operations, instead of just the fh field.
 
         This gives you access to direct_io, keep_cache, etc.
+
+        Setting raw_read to True will cause FUSE to call Operations.readinto
+        with a writable memoryview of the kernel buffer instead of read, so
+        data is not copied through intermediate strings.
         '''
 
         self.operations = operations
         self.raw_fi = raw_fi
+        self.raw_read = raw_read
         self.encoding = encoding
 
         args = ['fuse']
@@ -579,6 +584,11 @@ class FUSE(object):
         else:
           fh = fip.contents.fh
 
+        if self.raw_read:
+            view = memoryview(cast(buf, POINTER(c_char * size)).contents)
+            return self.operations('readinto', self._decode_optional_path(path),
+                                               view, offset, fh)
+
         ret = self.operations('read', self._decode_optional_path(path), size,
                                       offset, fh)
 
@@ -902,6 +912,16 @@ class Operations(object):
 
         raise FuseOSError(EIO)
 
+    def readinto(self, path, buf, offset, fh):
+        '''
+        Fills writable buffer buf with data at offset, returns number of
+        bytes read. Called instead of read if FUSE was created with raw_read.
+        '''
+
+        data = self.read(path, len(buf), offset, fh)
+        buf[:len(data)] = data
+        return len(data)
+
     def readdir(self, path, fh):
         '''
         Can return either a list of names, or a list of (name, attrs, offset)
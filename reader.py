@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+from Queue import Full, Queue
+
+from cache import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+class ReadAhead(object):
+    """
+    Read-ahead state of one file handle.
+    window is the number of blocks fetched ahead, it grows while reads are sequential and drops on random access.
+    Queued blocks of older generation are skipped, generation changes on random access and release.
+    """
+    __slots__ = ('next_offset', 'window', 'last_block', 'ahead', 'generation')
+
+    def __init__(self):
+        self.next_offset = 0
+        self.window = 0
+        self.last_block = -1
+        self.ahead = -1
+        self.generation = 0
+
+    # Drop blocks queued for the handle
+    def cancel(self):
+        self.generation += 1
+
+
+class BlockReader(object):
+    """
+    Reads file content through BlockCache.
+    Missing blocks are downloaded by range requests, blocks ahead of sequential reads are fetched by background workers.
+    Large files are fetched by several concurrent range downloads, reassembled in block order.
+    A block being downloaded is awaited instead of being requested twice.
+    Blocks are kept on disk by content_hash if BlockStore is given, unchanged files are read without network traffic.
+    """
+    # Number of read-ahead worker threads
+    workers = 4
+    # Max read-ahead window in blocks, 0 disables read-ahead
+    max_window = 8
+    # Files of this size in bytes and larger are fetched by parallel range downloads from the first read
+    parallel_size = 64 * 1024 * 1024
+    # Share of BlockCache capacity the window of one handle may take, defaults fit the full max_window
+    cache_share = 0.5
+
+    def __init__(self, api, blocks, store=None, flights=None):
+        super(BlockReader, self).__init__()
+        self.ar = api
+        self.blocks = blocks
+        # Optional on-disk BlockStore
+        self.store = store
+        # Downloads in flight, shared with other requests of the filesystem
+        self.flights = flights if flights is not None else SingleFlight()
+        # Blocks queued by all handles fit in half of the cache, requests over are dropped
+        self._queue = Queue(max(self.workers, blocks.max_bytes // blocks.block_size // 2))
+
+    def stats(self):
+        stats = self.blocks.stats()
+        if self.store is not None:
+            stats['disk'] = self.store.stats()
+        return stats
+
+    # Worker threads have to be started after FUSE has daemonized
+    def start(self):
+        if self.max_window <= 0:
+            return
+        for i in range(self.workers):
+            worker = threading.Thread(target=self._run, name='ReadAhead-%s' % i)
+            worker.daemon = True
+            worker.start()
+
+    # Returns length bytes of entry revision at offset, state is ReadAhead of the reading handle or None
+    def read(self, entry, offset, length, state=None):
+        return ''.join(block[start:stop] for block, start, stop in self._slices(entry, offset, length, state))
+
+    # Fill writable buffer with content at offset, returns number of bytes read.
+    # Cached blocks, strings or mmaps of stored blocks, are copied straight into buf without intermediate strings.
+    def readinto(self, entry, buf, offset, state=None):
+        pos = 0
+        for block, start, stop in self._slices(entry, offset, len(buf), state):
+            buf[pos:pos + stop - start] = buffer(block, start, stop - start)
+            pos += stop - start
+        return pos
+
+    # Generator of (block, start, stop) slices covering the range in order
+    def _slices(self, entry, offset, length, state):
+        end = min(offset + length, entry.size)
+        if offset >= end:
+            return
+        block_size = self.blocks.block_size
+        first, last = offset // block_size, (end - 1) // block_size
+        if state is not None:
+            self._read_ahead(entry, state, offset, end, last)
+        if self._is_parallel(entry) and last > first:
+            # Remaining blocks of long read are downloaded by workers meanwhile
+            for index in xrange(first + 1, last + 1):
+                if not self.blocks.has((entry.path_lower, entry.rev), index) and not self._put(entry, index, state):
+                    break
+        for index in xrange(first, last + 1):
+            start = index * block_size
+            block = self.get_block(entry, index)
+            yield block, max(offset - start, 0), min(end - start, len(block))
+
+    # Window doubles with every block consumed sequentially and is reset by random access
+    def _read_ahead(self, entry, state, offset, end, last):
+        if self.max_window <= 0:
+            return
+        if offset != state.next_offset:
+            # Blocks queued for the previous position are not needed any more
+            state.cancel()
+            state.window = 0
+            state.ahead = last
+        elif last > state.last_block:
+            # Large files start with one download per worker
+            initial = self.workers if self._is_parallel(entry) else 1
+            state.window = min(max(initial, state.window * 2), max(self.max_window, initial))
+            # Prefetched blocks must not evict each other before being read
+            state.window = min(state.window, self._window_limit())
+        state.next_offset = end
+        state.last_block = last
+        if not state.window:
+            return
+        blocks = (entry.size - 1) // self.blocks.block_size + 1
+        for index in xrange(max(last, state.ahead) + 1, min(last + state.window + 1, blocks)):
+            if not self._put(entry, index, state):
+                break
+            state.ahead = index
+
+    def _window_limit(self):
+        return max(1, int(self.blocks.max_bytes * self.cache_share) // self.blocks.block_size)
+
+    # Queue block for workers, returns False if queue is full
+    def _put(self, entry, index, state):
+        try:
+            self._queue.put_nowait((entry, index, state, state.generation if state is not None else None))
+            return True
+        except Full:
+            logger.debug('Read-ahead queue is full, block %s of %s is not prefetched', index, entry.path)
+            return False
+
+    def _is_parallel(self, entry):
+        return self.max_window > 0 and entry.size >= self.parallel_size
+
+    def _run(self):
+        while True:
+            entry, index, state, generation = self._queue.get()
+            if state is not None and state.generation != generation:
+                continue
+            try:
+                self.get_block(entry, index)
+            except Exception as e:
+                logger.debug('Read-ahead of block %s of %s failed', index, entry.path)
+                logger.debug(e, exc_info=True)
+
+    # Returns content block of entry revision
+    def get_block(self, entry, index):
+        key = (entry.path_lower, entry.rev)
+        block = self.blocks.get(key, index)
+        if block is not None:
+            return block
+        return self.flights.do(('download', key, index), self._fetch, entry, index)
+
+    def _fetch(self, entry, index):
+        block = self._load(entry, index)
+        self.blocks.put((entry.path_lower, entry.rev), index, block)
+        return block
+
+    # Returns block from disk or downloads it
+    def _load(self, entry, index):
+        content_key = entry.content_hash or entry.rev
+        if self.store is None or not content_key:
+            return self._download(entry, index)
+        block = self.store.get(content_key, self.blocks.block_size, index)
+        if block is None:
+            block = self._download(entry, index)
+            # Downloaded content is served from mapped block file as well
+            block = self.store.put(content_key, self.blocks.block_size, index, block) or block
+        return block
+
+    def _download(self, entry, index):
+        start = index * self.blocks.block_size
+        length = min(self.blocks.block_size, entry.size - start)
+        # Download exactly the opened revision, content stays consistent with cached size
+        source = 'rev:' + entry.rev if entry.rev else entry.path
+        logger.debug('Downloading block %s of %s, bytes %s-%s', index, entry.path, start, start + length - 1)
+        item = self.ar.download(source, start, length)
+        if item.is_error:
+            raise IOError('Could not download %s: %s' % (entry.path, item.error_summary))
+        return item.file_handle.read()
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import mmap
+import os
+import sqlite3
+import threading
+from Queue import Queue
+from collections import OrderedDict
+from time import time
+
+from cache import cache_key
+from dbxobject import DbxEntry
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataStore(object):
+    """
+    Persistent SQLite store of folder listings and their list_folder cursors.
+    Rows are keyed by account and mounted root folder, so several mounts can share one cache dir.
+    """
+    file_name = 'metadata.sqlite'
+
+    def __init__(self, cache_dir, account_id, root_folder):
+        super(MetadataStore, self).__init__()
+        self.account = account_id
+        self.root = root_folder or '/'
+        self._lock = threading.Lock()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self._db = sqlite3.connect(os.path.join(cache_dir, self.file_name), check_same_thread=False)
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS folders (
+                account TEXT, root TEXT, path_lower TEXT, entry TEXT, cursor TEXT, listed REAL,
+                PRIMARY KEY (account, root, path_lower));
+            CREATE TABLE IF NOT EXISTS entries (
+                account TEXT, root TEXT, parent TEXT, name TEXT, entry TEXT,
+                PRIMARY KEY (account, root, parent, name));
+        ''')
+
+    # Returns tuple (folder entry, list of child entries, cursor, listed) or None
+    def load_folder(self, path):
+        key = cache_key(path)
+        with self._lock:
+            row = self._db.execute('SELECT entry, cursor, listed FROM folders WHERE account=? AND root=? AND '
+                                   'path_lower=?', (self.account, self.root, key)).fetchone()
+            if row is None:
+                return None
+            rows = self._db.execute('SELECT entry FROM entries WHERE account=? AND root=? AND parent=?',
+                                    (self.account, self.root, key)).fetchall()
+        return _to_entry(row[0]), [_to_entry(x[0]) for x in rows], row[1], row[2]
+
+    # Replace stored listing of folder
+    def save_folder(self, folder, entries, cursor):
+        key = cache_key(folder.path_lower)
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?, ?, ?)',
+                             (self.account, self.root, key, _from_entry(folder), cursor, time()))
+            self._db.execute('DELETE FROM entries WHERE account=? AND root=? AND parent=?',
+                             (self.account, self.root, key))
+            self._db.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                                 ((self.account, self.root, key, os.path.basename(cache_key(x.path_lower)),
+                                   _from_entry(x)) for x in entries))
+
+    # Forget path and its subtree
+    def delete(self, path):
+        key = cache_key(path)
+        pattern = key.rstrip('/').replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '/%'
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM folders WHERE account=? AND root=? AND '
+                             "(path_lower=? OR path_lower LIKE ? ESCAPE '\\')", (self.account, self.root, key, pattern))
+            self._db.execute('DELETE FROM entries WHERE account=? AND root=? AND '
+                             "(parent=? OR parent LIKE ? ESCAPE '\\')", (self.account, self.root, key, pattern))
+            self._db.execute('DELETE FROM entries WHERE account=? AND root=? AND parent=? AND name=?',
+                             (self.account, self.root, os.path.dirname(key), os.path.basename(key)))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class BlockStore(object):
+    """
+    Size-bounded on-disk cache of file content blocks, least recently used blocks are removed first.
+    Blocks are keyed by content_hash (or rev) of the file, so unchanged content is reused across mounts and renames.
+    Blocks are served as read-only mmaps, mapping stays valid even if the block file is removed meanwhile.
+    Every map holds a file descriptor, BlockCache bounds the number of cached maps.
+    """
+    dir_name = 'blocks'
+    # Max size of stored blocks in bytes
+    max_bytes = 1024 * 1024 * 1024
+
+    def __init__(self, cache_dir):
+        super(BlockStore, self).__init__()
+        self.dir = os.path.join(cache_dir, self.dir_name)
+        self._lock = threading.Lock()
+        self._files = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+        self._scan()
+
+    # Index blocks stored by previous mounts, oldest first
+    def _scan(self):
+        files = []
+        for root, dirs, names in os.walk(self.dir):
+            for name in names:
+                path = os.path.join(root, name)
+                if name.endswith('.tmp'):
+                    os.remove(path)
+                    continue
+                st = os.stat(path)
+                files.append((st.st_mtime, os.path.relpath(path, self.dir), st.st_size))
+        for mtime, name, size in sorted(files):
+            self._files[name] = size
+            self.bytes += size
+        self._evict()
+
+    def stats(self):
+        return {
+            'blocks': len(self._files),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+    # File name of block, key is content_hash or rev of the file
+    def _name(self, key, size, index):
+        return os.path.join(key[:2], '%s.%s.%s' % (key, size, index))
+
+    # Returns read-only mmap of stored block or None
+    def get(self, key, size, index):
+        name = self._name(key, size, index)
+        with self._lock:
+            stored = self._files.pop(name, None)
+            if stored is None:
+                self.misses += 1
+                return None
+            self._files[name] = stored
+            self.hits += 1
+        path = os.path.join(self.dir, name)
+        try:
+            data = _map(path)
+            os.utime(path, None)
+            if len(data) == stored:
+                return data
+            data.close()
+            logger.debug('Stored block has wrong size: %s', name)
+        except EnvironmentError:
+            logger.debug('Stored block could not be read: %s', name)
+        # Unreadable block is removed, disk usage stays accounted
+        with self._lock:
+            self.bytes -= self._files.pop(name, 0)
+        _remove(path)
+        return None
+
+    # Store block, returns its read-only mmap or None if block could not be stored or mapped
+    def put(self, key, size, index, data):
+        name = self._name(key, size, index)
+        path = os.path.join(self.dir, name)
+        # Block is written under temporary name, readers never see partial content
+        tmp = '%s.%s.tmp' % (path, threading.current_thread().ident)
+        try:
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # Created already
+                pass
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, path)
+        except EnvironmentError as e:
+            logger.error('Could not store block: %s', name)
+            logger.debug(e, exc_info=True)
+            _remove(tmp)
+            return None
+        with self._lock:
+            self.bytes += len(data) - self._files.pop(name, 0)
+            self._files[name] = len(data)
+            self._evict()
+        # Block stays stored and accounted if it can not be mapped, e.g. out of descriptors
+        try:
+            return _map(path)
+        except EnvironmentError as e:
+            logger.debug('Could not map stored block: %s', name)
+            logger.debug(e, exc_info=True)
+            return None
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self._files:
+            name, size = self._files.popitem(last=False)
+            self.bytes -= size
+            _remove(os.path.join(self.dir, name))
+
+
+# Map whole file read-only
+def _map(path):
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _from_entry(entry):
+    return json.dumps(list(entry))
+
+
+def _to_entry(data):
+    return DbxEntry(*json.loads(data))
+
+
+class StoreSync(threading.Thread):
+    """
+    Background worker keeping MetadataStore in sync with the cache.
+    Listings restored from disk are revalidated with their stored cursor, fresh listings are written to disk.
+    """
+
+    def __init__(self, api, cache, store):
+        super(StoreSync, self).__init__(name='StoreSync')
+        self.daemon = True
+        self.ar = api
+        self.cache = cache
+        self.store = store
+        self._queue = Queue()
+
+    # Restore folder listing from disk, returns True if listing has been found.
+    # Restored listing is revalidated once, until then it does not prove absence of other entries.
+    def restore(self, path):
+        if self.cache.is_restored(path):
+            return True
+        stored = self.store.load_folder(path)
+        if stored is None:
+            return False
+        folder, entries, cursor, listed = stored
+        logger.debug('Restored %s entries of %s listed at %s', len(entries), path, listed)
+        self.cache.load(folder, entries)
+        self._queue.put((self._revalidate, folder, cursor))
+        return True
+
+    # Save complete folder listing
+    def save(self, folder, cursor):
+        if cursor is not None:
+            self._queue.put((self._save, folder.entry, cursor))
+
+    def delete(self, path):
+        self._queue.put((self.store.delete, path))
+
+    def run(self):
+        while True:
+            task = self._queue.get()
+            try:
+                task[0](*task[1:])
+            except Exception as e:
+                logger.error('Metadata store task failed: %s', task[0].__name__)
+                logger.debug(e, exc_info=True)
+
+    # Listing is copied under cache lock, watcher and FUSE threads change the cache meanwhile
+    def _save(self, entry, cursor):
+        listing = self.cache.listing(entry.path_lower)
+        if listing is not None:
+            self.store.save_folder(listing[0], listing[1], cursor)
+
+    # Apply changes made since cursor was stored, folder is relisted if cursor is not valid any more
+    def _revalidate(self, entry, cursor):
+        changes = 0
+        page = None
+        while page is None or page.has_more:
+            page = self.ar.list_folder_continue(cursor)
+            if page.is_error:
+                logger.debug('Stored cursor of %s is not valid, relisting', entry.path)
+                started = time()
+                item = self.ar.list_folder(entry.path)
+                if item.is_error or item.is_deleted:
+                    self.cache.remove(entry.path)
+                    self.store.delete(entry.path)
+                    return
+                self.cache.add(item, started)
+                self._save(entry, item.cursor)
+                return
+            changes += self.cache.apply_changes(page.entries)
+            cursor = page.cursor
+        logger.debug('Revalidated %s, %s changes', entry.path, changes)
+        self.cache.set_validated(entry.path)
+        self._save(entry, cursor)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+import shutil
+import tempfile
+import time
+from StringIO import StringIO
+from unittest import TestCase
+
+from cache import BlockCache
+from dbxobject import DbxEntry, DbxObject
+from reader import BlockReader, ReadAhead
+from store import BlockStore
+from test_data import *
+
+
+class FakeApi(object):
+    def __init__(self, content):
+        self.content = content
+        self.downloads = []
+
+    def download(self, path, seek=False, length=None):
+        self.downloads.append((path, seek, length))
+        return DbxObject({}, file_handle=StringIO(self.content[seek:seek + length]))
+
+
+class TestBlockReader(TestCase):
+    def setUp(self):
+        super(TestBlockReader, self).setUp()
+        self.content = ''.join(chr(ord('a') + i % 26) for i in range(100))
+        self.entry = DbxEntry.from_dict(dict(data_file, size=len(self.content)))
+        self.api = FakeApi(self.content)
+        self.blocks = BlockCache()
+        self.blocks.block_size = 10
+        self.reader = BlockReader(self.api, self.blocks)
+
+    def test_read(self):
+        self.assertEquals(self.content[5:27], self.reader.read(self.entry, 5, 22))
+        self.assertEquals([("rev:a5c842aa4", 0, 10), ("rev:a5c842aa4", 10, 10), ("rev:a5c842aa4", 20, 10)],
+                          self.api.downloads)
+        self.assertEquals(self.content[12:18], self.reader.read(self.entry, 12, 6))
+        self.assertEquals(3, len(self.api.downloads))
+
+    def test_read_end(self):
+        self.assertEquals(self.content[95:], self.reader.read(self.entry, 95, 20))
+        self.assertEquals(("rev:a5c842aa4", 90, 10), self.api.downloads[0])
+        self.assertEquals('', self.reader.read(self.entry, 100, 20))
+
+    def test_read_ahead(self):
+        state = ReadAhead()
+        self.reader.read(self.entry, 0, 5, state)
+        self.assertEquals(1, state.window)
+        self.assertEquals(1, self.reader._queue.qsize())
+        self.reader.read(self.entry, 5, 10, state)
+        self.assertEquals(2, state.window)
+        self.assertEquals(3, state.ahead)
+        self.reader.read(self.entry, 50, 5, state)
+        self.assertEquals(0, state.window)
+        self.assertEquals(3, self.reader._queue.qsize())
+
+    def test_read_ahead_cancel(self):
+        state = ReadAhead()
+        self.reader.read(self.entry, 0, 5, state)
+        self.reader.read(self.entry, 5, 10, state)
+        self.assertEquals(3, self.reader._queue.qsize())
+        # Random access drops blocks queued ahead of the old position
+        self.reader.read(self.entry, 50, 5, state)
+        self.reader._queue.put((self.entry, 9, None, None))
+        self.reader.workers = 1
+        self.reader.start()
+        for i in range(500):
+            if len(self.api.downloads) == 4:
+                break
+            time.sleep(0.01)
+        self.assertEquals([0, 10, 50, 90], [x[1] for x in self.api.downloads])
+
+    def test_read_ahead_limit(self):
+        self.blocks.max_bytes = 20
+        state = ReadAhead()
+        for offset in range(0, 50, 10):
+            self.reader.read(self.entry, offset, 10, state)
+        self.assertEquals(1, state.window)
+
+    def test_read_ahead_limit_defaults(self):
+        blocks = BlockCache()
+        blocks.block_size = 4194304
+        blocks.max_bytes = 67108864
+        self.assertEquals(BlockReader.max_window, BlockReader(self.api, blocks)._window_limit())
+
+    def test_read_ahead_queue_full(self):
+        reader = BlockReader(self.api, self.blocks)
+        reader._queue.maxsize = 2
+        state = ReadAhead()
+        reader.read(self.entry, 0, 10, state)
+        reader.read(self.entry, 10, 10, state)
+        reader.read(self.entry, 20, 10, state)
+        self.assertEquals(2, reader._queue.qsize())
+        self.assertEquals(2, state.ahead)
+
+    def test_read_ahead_parallel(self):
+        self.reader.parallel_size = 50
+        self.reader.workers = 3
+        state = ReadAhead()
+        self.reader.read(self.entry, 0, 5, state)
+        self.assertEquals(3, state.window)
+        self.assertEquals(3, self.reader._queue.qsize())
+
+    def test_read_parallel(self):
+        self.reader.parallel_size = 50
+        self.assertEquals(self.content[5:35], self.reader.read(self.entry, 5, 30))
+        self.assertEquals(3, self.reader._queue.qsize())
+
+    def test_read_store(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            self.reader.store = BlockStore(tmp)
+            self.assertEquals(self.content[5:15], self.reader.read(self.entry, 5, 10))
+            reader = BlockReader(self.api, BlockCache(), BlockStore(tmp))
+            reader.blocks.block_size = 10
+            self.assertEquals(self.content[5:15], reader.read(self.entry, 5, 10))
+            buf = bytearray(10)
+            self.assertEquals(10, reader.readinto(self.entry, memoryview(buf), 5))
+            self.assertEquals(self.content[5:15], str(buf))
+            self.assertEquals(2, len(self.api.downloads))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_readinto(self):
+        buf = bytearray(30)
+        self.assertEquals(30, self.reader.readinto(self.entry, memoryview(buf), 5, ReadAhead()))
+        self.assertEquals(self.content[5:35], str(buf))
+        self.assertEquals(10, self.reader.readinto(self.entry, memoryview(buf), 90))
+        self.assertEquals(self.content[90:], str(buf[:10]))
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+
+import mmap
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from cache import BlockCache, FileHandleCache, ItemCache, SingleFlight
+from dbxobject import DbxObject
+from test_data import *
+
+
+class TestItemCache(TestCase):
+    def setUp(self):
+        super(TestItemCache, self).setUp()
+        self.cache = ItemCache()
+
+    def test_add(self):
+        item = self.cache.add(DbxObject(data_folder_entries))
+        self.assertEquals("/test", item.path)
+        self.assertTrue(item.is_folder)
+        self.assertTrue(item.has_entries)
+        self.assertEquals(3, len(item.sub_items))
+        self.assertIs(item, self.cache.get("/test"))
+        self.assertTrue(self.cache.is_in_cache("/test/ss"))
+        self.assertFalse(self.cache.get("/test/ss").has_entries)
+
+    def test_add_file(self):
+        item = self.cache.add(DbxObject(data_file))
+        self.assertTrue(item.is_file)
+        self.assertFalse(item.has_entries)
+        self.assertEquals(19754, item.size)
+        self.assertFalse(item.is_expired)
+
+    def test_add_page(self):
+        folder = self.cache.add(DbxObject(data_folder_metadata))
+        self.assertFalse(folder.has_entries)
+        started = time.time()
+        sub_items = self.cache.add_page(folder, DbxObject(data_folder_entries))
+        self.assertEquals(3, len(sub_items))
+        self.assertFalse(folder.has_entries)
+        self.assertIs(sub_items[0], self.cache.get("/test/subfolder"))
+        self.cache.set_listed(folder, started)
+        self.assertTrue(folder.has_entries)
+        self.assertEquals(3, len(folder.sub_items))
+
+    def test_child_index(self):
+        folder = self.cache.add(DbxObject(data_folder_entries))
+        self.assertTrue(folder.has_entry("/test/SS"))
+        self.assertIs(folder.get_entry("/test/ss"), self.cache.get("/TEST/Ss"))
+        self.assertIsNone(folder.get_entry("/test/xx"))
+        self.assertIsNotNone(folder.remove_entry("/test/ss"))
+        self.assertFalse(folder.has_entry("/test/ss"))
+
+    def test_add_replaces_entry(self):
+        folder = self.cache.add(DbxObject(data_folder_entries))
+        item = self.cache.add(DbxObject({
+            ".tag": "folder", "path_lower": "/test/ss", "path_display": "/test/ss"}))
+        self.assertIs(item, folder.get_entry("/test/ss"))
+        self.assertTrue(folder.has_entries)
+
+    def test_remove(self):
+        root = self.cache.add(DbxObject({".tag": "folder", "path_lower": "/", "path_display": "/",
+                                         "entries": [data_folder_metadata]}))
+        self.cache.add(DbxObject(data_folder_entries))
+        self.assertTrue(self.cache.remove("/test/ss"))
+        self.assertTrue(self.cache.is_in_cache("/test"))
+        self.assertFalse(self.cache.get("/test").has_entries)
+        self.assertTrue(self.cache.remove("/test"))
+        self.assertFalse(root.has_entries)
+        self.assertFalse(self.cache.is_in_cache("/test"))
+        self.assertFalse(self.cache.is_in_cache("/test/ss"))
+        self.assertFalse(self.cache.remove("/test"))
+
+    def test_remove_subtree(self):
+        self.cache.add(DbxObject(data_folder_entries_recursive))
+        self.cache.add(DbxObject(dict(data_folder_metadata, path_lower="/test/subfolder",
+                                      path_display="/test/subfolder", entries=[data_file])))
+        self.assertTrue(self.cache.is_in_cache("/test/subfolder/a6w.odt"))
+        self.assertTrue(self.cache.remove("/test"))
+        self.assertFalse(self.cache.is_in_cache("/test/subfolder/a6w.odt"))
+        self.assertFalse(self.cache.is_in_cache("/test/subfolder"))
+
+    def test_delete(self):
+        folder = self.cache.add(DbxObject(data_folder_entries))
+        self.assertTrue(self.cache.delete("/test/ss"))
+        self.assertFalse(self.cache.is_in_cache("/test/ss"))
+        self.assertTrue(folder.has_entries)
+
+    def test_move(self):
+        root = self.cache.add(DbxObject({".tag": "folder", "path_lower": "/", "path_display": "/",
+                                         "entries": [data_folder_metadata]}))
+        self.cache.add(DbxObject(dict(data_folder_metadata, path_lower="/test/subfolder",
+                                      path_display="/test/subfolder", entries=[data_file])))
+        moved = self.cache.move("/test", DbxObject(dict(data_folder_metadata, path_lower="/moved",
+                                                        path_display="/Moved")))
+        self.assertFalse(self.cache.is_in_cache("/test"))
+        self.assertIs(moved, self.cache.get("/moved"))
+        self.assertTrue(root.has_entries)
+        self.assertTrue(root.has_entry("/moved"))
+        item = self.cache.get("/moved/subfolder/a6w.odt")
+        self.assertEquals("/Moved/subfolder/a6w.odt", item.path)
+        self.assertEquals("/moved/subfolder/a6w.odt", item.path_lower)
+        self.assertEquals(19754, item.size)
+        self.assertTrue(self.cache.get("/moved/subfolder").has_entries)
+
+    def test_move_placeholder(self):
+        for path in ("/a/b/c", "/a/b/d"):
+            self.cache.add(DbxObject(dict(data_file, path_lower=path, path_display=path)))
+        self.assertEquals(2, self.cache.entries)
+        self.cache.move("/a", DbxObject(dict(data_folder_metadata, path_lower="/e", path_display="/e")))
+        self.assertEquals(1, self.cache.entries)
+        self.assertFalse(self.cache.is_in_cache("/a/b/c"))
+        self.assertTrue(self.cache.is_in_cache("/e"))
+
+    def test_set_listed_prunes(self):
+        folder = self.cache.add(DbxObject(data_folder_entries))
+        self.cache.add(DbxObject(dict(data_folder_metadata, path_lower="/test/xx/yy", path_display="/test/xx/yy")))
+        started = time.time() + 1
+        self.cache.add_page(folder, DbxObject({"entries": [data_folder_entries["entries"][0]]}))
+        folder.children["subfolder"].created = started
+        self.cache.set_listed(folder, started)
+        self.assertEquals(["/test/subfolder"], [x.path for x in folder.sub_items])
+        self.assertFalse(self.cache.is_in_cache("/test/xx/yy"))
+
+    def test_set_tree_listed(self):
+        folder = self.cache.add(DbxObject(data_folder_metadata))
+        started = time.time()
+        self.cache.add_page(folder, DbxObject(data_folder_entries_recursive))
+        self.cache.set_tree_listed(folder, started)
+        self.assertEquals(3, len(folder.sub_items))
+        subfolder = self.cache.get("/test/subfolder")
+        self.assertTrue(subfolder.has_entries)
+        self.assertEquals(3, len(subfolder.sub_items))
+        self.assertTrue(self.cache.get("/test/subfolder/aa").has_entries)
+        self.assertFalse(self.cache.get("/test/subfolder/a").has_entries)
+
+    def test_set_tree_listed_changed(self):
+        folder = self.cache.add(DbxObject(data_folder_metadata))
+        started = time.time() - 1
+        self.cache.add_page(folder, DbxObject(data_folder_entries_recursive))
+        # Empty folder changed while the tree was listed
+        self.cache.apply_changes([{".tag": "deleted", "path_lower": "/test/subfolder/aa/old",
+                                   "path_display": "/test/subfolder/aa/old"}])
+        self.cache.set_tree_listed(folder, started)
+        self.assertTrue(self.cache.get("/test/subfolder").has_entries)
+        self.assertFalse(self.cache.get("/test/subfolder/aa").has_entries)
+
+    def test_apply_changes(self):
+        folder = self.cache.add(DbxObject(data_folder_entries))
+        changes = self.cache.apply_changes([
+            {".tag": "deleted", "path_lower": "/test/ss", "path_display": "/test/ss"},
+            dict(data_file, path_lower="/test/new.odt", path_display="/test/New.odt"),
+            dict(data_file, path_lower="/other/a.odt", path_display="/other/a.odt")])
+        self.assertEquals(2, changes)
+        self.assertFalse(self.cache.is_in_cache("/test/ss"))
+        self.assertEquals("/test/New.odt", folder.get_entry("/test/new.odt").path)
+        self.assertFalse(self.cache.is_in_cache("/other/a.odt"))
+        self.assertTrue(folder.has_entries)
+
+    def test_apply_changes_while_listing(self):
+        folder = self.cache.add(DbxObject(data_folder_entries))
+        started = time.time() - 1
+        # Page fetched before the deletion is cached after it
+        self.cache.apply_changes([{".tag": "deleted", "path_lower": "/test/ss", "path_display": "/test/ss"}])
+        self.cache.add_page(folder, DbxObject(data_folder_entries))
+        self.cache.set_listed(folder, started)
+        self.assertTrue(self.cache.is_in_cache("/test/ss"))
+        self.assertFalse(folder.has_entries)
+        self.cache.set_listed(folder, time.time() + 1)
+        self.assertTrue(folder.has_entries)
+
+    def test_add_after_change(self):
+        self.cache.add(DbxObject(data_folder_entries))
+        started = time.time() - 1
+        self.cache.apply_changes([{".tag": "deleted", "path_lower": "/test/ss", "path_display": "/test/ss"}])
+        # Response fetched before the deletion
+        folder = self.cache.add(DbxObject(data_folder_entries), started)
+        self.assertFalse(folder.has_entries)
+        folder = self.cache.add(DbxObject(data_folder_entries))
+        self.assertTrue(folder.has_entries)
+
+    def test_listing(self):
+        self.assertIsNone(self.cache.listing("/test"))
+        self.cache.add(DbxObject(data_folder_entries))
+        folder, entries = self.cache.listing("/TEST")
+        self.assertEquals("/test", folder.path_lower)
+        self.assertEquals(3, len(entries))
+        self.assertIsNone(self.cache.listing("/test/ss"))
+
+    def test_expire(self):
+        folder = self.cache.add(DbxObject(data_folder_entries))
+        self.cache.expire("/test")
+        self.assertTrue(folder.is_expired)
+        self.assertTrue(self.cache.get("/test/ss").is_expired)
+        self.assertTrue(folder.has_entries)
+
+    def test_threads(self):
+        self.cache.max_entries = 50
+        errors = []
+
+        def worker(n):
+            try:
+                for i in range(200):
+                    path = "/test/t%s/f%s" % (n, i % 20)
+                    self.cache.add(DbxObject(dict(data_file, path_lower=path, path_display=path)))
+                    self.cache.get(path)
+                    if i % 7 == 0:
+                        self.cache.remove("/test/t%s" % n)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals([], errors)
+        self.assertLessEqual(self.cache.entries, 50)
+
+    def _add_files(self, count):
+        folder = self.cache.add(DbxObject(dict(data_folder_metadata)))
+        entries = [dict(data_file, path_lower="/test/f%s" % i, path_display="/test/f%s" % i) for i in range(count)]
+        return folder, self.cache.add_page(folder, DbxObject({"entries": entries}))
+
+    def test_stats(self):
+        self._add_files(10)
+        stats = self.cache.stats()
+        self.assertEquals(11, stats['entries'])
+        self.assertGreater(stats['bytes'], 0)
+        self.assertTrue(self.cache.remove("/test"))
+        self.assertEquals(0, self.cache.stats()['entries'])
+        self.assertEquals(0, self.cache.stats()['bytes'])
+
+    def test_evict_entries(self):
+        self.cache.max_entries = 5
+        folder, items = self._add_files(10)
+        self.assertLessEqual(self.cache.entries, 5)
+        self.assertGreater(self.cache.evictions, 0)
+        self.assertFalse(folder.has_entries)
+
+    def test_evict_bytes(self):
+        self.cache.max_bytes = 4000
+        self._add_files(100)
+        self.assertLessEqual(self.cache.bytes, 4000)
+
+    def test_evict_pinned(self):
+        self.cache.max_entries = 3
+        self.cache.pin("/test/f1")
+        folder, items = self._add_files(10)
+        self.assertTrue(self.cache.is_in_cache("/test"))
+        self.assertTrue(self.cache.is_in_cache("/test/f1"))
+        self.cache.unpin("/test/f1")
+        self.assertFalse(self.cache.is_pinned("/test"))
+
+
+class TestBlockCache(TestCase):
+    def setUp(self):
+        super(TestBlockCache, self).setUp()
+        self.blocks = BlockCache()
+        self.blocks.max_bytes = 10
+
+    def test_get_put(self):
+        self.assertIsNone(self.blocks.get(("/a", "1"), 0))
+        self.blocks.put(("/a", "1"), 0, "0123")
+        self.assertEquals("0123", self.blocks.get(("/a", "1"), 0))
+        self.assertIsNone(self.blocks.get(("/a", "2"), 0))
+        self.assertEquals(1, self.blocks.hits)
+        self.assertEquals(2, self.blocks.misses)
+
+    def test_evict_lru(self):
+        self.blocks.put(("/a", "1"), 0, "0123")
+        self.blocks.put(("/a", "1"), 1, "4567")
+        self.blocks.get(("/a", "1"), 0)
+        self.blocks.put(("/a", "1"), 2, "89ab")
+        self.assertIsNone(self.blocks.get(("/a", "1"), 1))
+        self.assertEquals("0123", self.blocks.get(("/a", "1"), 0))
+        self.assertEquals(8, self.blocks.bytes)
+        self.assertEquals(1, self.blocks.evictions)
+
+
+    def test_max_maps(self):
+        tmp = tempfile.NamedTemporaryFile()
+        tmp.write('0123456789')
+        tmp.flush()
+        self.blocks.max_maps = 2
+        for i in range(3):
+            self.blocks.put('/test/a', i, mmap.mmap(tmp.fileno(), 0, access=mmap.ACCESS_READ))
+        self.blocks.put('/test/a', 3, '0123')
+        stats = self.blocks.stats()
+        self.assertEquals(2, stats['maps'])
+        self.assertEquals(4, stats['bytes'])
+        self.assertIsNone(self.blocks.get('/test/a', 0))
+        self.assertEquals('0123456789', self.blocks.get('/test/a', 2)[:])
+        self.assertTrue(self.blocks.has('/test/a', 1))
+        tmp.close()
+
+
+class TestFileHandleCache(TestCase):
+    def setUp(self):
+        super(TestFileHandleCache, self).setUp()
+        self.openfh = FileHandleCache()
+
+    def test_new_release(self):
+        fh = self.openfh.new_fh(item=DbxObject(data_file))
+        self.assertGreater(fh, 0)
+        self.assertEquals("/test/subfolder/a6w.odt", self.openfh.get_fh(fh).path)
+        self.assertTrue(self.openfh.release_fh(fh))
+        self.assertFalse(self.openfh.release_fh(fh))
+        fh1 = self.openfh.new_fh(item=DbxObject(data_file))
+        self.assertNotEqual(fh, fh1)
+        self.assertFalse(self.openfh.get_fh(fh))
+        self.assertTrue(self.openfh.get_fh(fh1))
+
+    def test_max_handles(self):
+        self.openfh.max_handles = 2
+        handles = [self.openfh.new_fh(path="/test/f%s" % i) for i in range(3)]
+        self.assertFalse(handles[2])
+        self.openfh.release_fh(handles[0])
+        self.assertTrue(self.openfh.new_fh(path="/test/f3"))
+
+    def test_unbounded(self):
+        handles = set(self.openfh.new_fh(path="/test/f%s" % i) for i in range(10000))
+        self.assertEquals(10000, len(handles))
+
+
+class TestSingleFlight(TestCase):
+    def test_do(self):
+        flights = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fetch(path):
+            calls.append(path)
+            started.set()
+            release.wait()
+            return path.upper()
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flights.do(('list_folder', '/a'), fetch, '/a')))
+                   for i in range(3)]
+        threads[0].start()
+        started.wait()
+        for t in threads[1:]:
+            t.start()
+        while flights.shared < 2:
+            time.sleep(0.01)
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEquals(['/a'], calls)
+        self.assertEquals(['/A'] * 3, results)
+        self.assertEquals('/B', flights.do(('list_folder', '/a'), lambda x: x.upper(), '/b'))
+
+    def test_error(self):
+        flights = SingleFlight()
+        with self.assertRaises(IOError):
+            flights.do('key', self._fail)
+        self.assertEquals(1, flights.do('key', lambda: 1))
+
+    def _fail(self):
+        raise IOError()
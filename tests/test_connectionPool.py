@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+import httplib
+import socket
+from unittest import TestCase
+
+from dbxapi import ConnectionPool, DbxRequest, PooledResponse
+
+
+class FakeConnection(object):
+    def __init__(self, host, timeout=None):
+        self.host = host
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeResponse(object):
+    def __init__(self, body):
+        self.body = body
+        self.closed = False
+
+    def read(self, amt=None):
+        if amt is None:
+            amt = len(self.body)
+        data, self.body = self.body[:amt], self.body[amt:]
+        if not self.body:
+            self.closed = True
+        return data
+
+    def isclosed(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+
+class TestConnectionPool(TestCase):
+    def setUp(self):
+        super(TestConnectionPool, self).setUp()
+        self.pool = ConnectionPool()
+        self.pool.connection_class = FakeConnection
+        self.pool.pool_size = 2
+
+    def test_get_put(self):
+        conn, reused = self.pool.get("api.dropboxapi.com")
+        self.assertFalse(reused)
+        self.pool.put("api.dropboxapi.com", conn)
+        conn1, reused = self.pool.get("api.dropboxapi.com")
+        self.assertTrue(reused)
+        self.assertIs(conn, conn1)
+        conn2, reused = self.pool.get("content.dropboxapi.com")
+        self.assertFalse(reused)
+        self.assertIsNot(conn, conn2)
+
+    def test_pool_size(self):
+        conns = [self.pool.get("api.dropboxapi.com")[0] for i in range(3)]
+        for conn in conns:
+            self.pool.put("api.dropboxapi.com", conn)
+        self.assertEquals(2, self.pool.idle_count("api.dropboxapi.com"))
+        self.assertTrue(conns[2].closed)
+
+    def test_idle_timeout(self):
+        conn, reused = self.pool.get("api.dropboxapi.com")
+        self.pool.put("api.dropboxapi.com", conn)
+        self.pool.idle_timeout = -1
+        conn1, reused = self.pool.get("api.dropboxapi.com")
+        self.assertFalse(reused)
+        self.assertTrue(conn.closed)
+
+    def test_response_release(self):
+        conn, reused = self.pool.get("api.dropboxapi.com")
+        r = PooledResponse(self.pool, "api.dropboxapi.com", conn, FakeResponse("0123456789"))
+        self.assertEquals("01234", r.fp.read(5))
+        self.assertEquals(0, self.pool.idle_count("api.dropboxapi.com"))
+        self.assertEquals("56789", r.read())
+        self.assertEquals(1, self.pool.idle_count("api.dropboxapi.com"))
+
+    def test_response_close(self):
+        conn, reused = self.pool.get("api.dropboxapi.com")
+        r = PooledResponse(self.pool, "api.dropboxapi.com", conn, FakeResponse("0123456789"))
+        r.close()
+        self.assertTrue(conn.closed)
+        self.assertEquals(0, self.pool.idle_count("api.dropboxapi.com"))
+
+
+class ScriptedConnection(FakeConnection):
+    # Each connection takes next (request error, response error) of the script
+    script = []
+
+    def __init__(self, host, timeout=None):
+        super(ScriptedConnection, self).__init__(host, timeout)
+        self.send_error, self.response_error = self.script.pop(0)
+        self.requests = 0
+
+    def request(self, method, url, body=None, headers=None):
+        self.requests += 1
+        if self.send_error is not None:
+            raise self.send_error
+
+    def getresponse(self):
+        if self.response_error is not None:
+            raise self.response_error
+        return FakeResponse("{}")
+
+
+class TestRequestRetry(TestCase):
+    def setUp(self):
+        super(TestRequestRetry, self).setUp()
+        self.request = DbxRequest()
+        self.request.pool = ConnectionPool()
+        self.request.pool.connection_class = ScriptedConnection
+
+    def _stale(self, send_error, response_error):
+        ScriptedConnection.script = [(send_error, response_error), (None, None)]
+        conn, reused = self.request.pool.get("api.dropboxapi.com")
+        self.request.pool.put("api.dropboxapi.com", conn)
+        return conn
+
+    def test_retry_send_failed(self):
+        conn = self._stale(socket.error(32, 'Broken pipe'), None)
+        r = self.request._request("https://api.dropboxapi.com/2/files/upload", "data", {})
+        self.assertTrue(conn.closed)
+        self.assertIsNot(conn, r._conn)
+
+    def test_retry_no_status_line(self):
+        self._stale(None, httplib.BadStatusLine("''"))
+        r = self.request._request("https://api.dropboxapi.com/2/files/upload", "data", {})
+        self.assertEquals("{}", r.read())
+
+    def test_no_retry_after_send(self):
+        conn = self._stale(None, socket.error(104, 'Connection reset by peer'))
+        self.assertRaises(socket.error, self.request._request, "https://api.dropboxapi.com/2/files/upload", "data",
+                          {})
+        self.assertEquals(1, conn.requests)
+        self.assertEquals(1, len(ScriptedConnection.script))
@@ -111,6 +111,22 @@ class TestDropboxAPI(TestCase):
         result = self.r.delete(file_name)
         self.assertFalse(result.is_error)
 
+    def test_upload_single(self):
+        file_name = "/test_upload_single.txt"
+        self.r.delete(file_name)
+        upload_file = FileHandle.new_upload_file_handle(file_name)
+        x = "TEST_" * 10
+        upload_file.buf = x
+        upload_file = self.r.upload_single(upload_file)
+        self.assertFalse(upload_file.upload_status.is_error)
+        self.assertEquals(file_name, upload_file.result.path)
+        self.assertEquals(0, upload_file.buf_size)
+        result = self.r.download(file_name)
+        self.assertFalse(result.is_error)
+        self.assertEquals(x, result.file_handle.read())
+        result = self.r.delete(file_name)
+        self.assertFalse(result.is_error)
+
 
     def test_copy(self):
         name = remote_dir +"/b/new_file.txt"
@@ -4,7 +4,7 @@ import copy
 import time
 from unittest import TestCase
 
-from dbxobject import DbxObject
+from dbxobject import DbxEntry, DbxObject
 from test_data import *
 
 
@@ -195,3 +195,35 @@ class TestDbxObject(TestCase):
     def test_size(self):
         a2 = DbxObject(data_file)
         self.assertEquals(19754, a2.size)
+
+
+class TestDbxEntry(TestCase):
+    def test_from_dict(self):
+        e = DbxObject(data_file).to_entry()
+        self.assertTrue(e.is_file)
+        self.assertFalse(e.is_folder)
+        self.assertEquals("/test/subfolder/a6w.odt", e.path)
+        self.assertEquals("a6w.odt", e.basename)
+        self.assertEquals("/test/subfolder", e.parent_path)
+        self.assertEquals(19754, e.size)
+        self.assertEquals("a5c842aa4", e.rev)
+        self.assertEquals(data_file['content_hash'], e.content_hash)
+        self.assertEquals(DbxObject(data_file).server_modified, e.server_modified)
+        self.assertEquals(DbxObject(data_file).client_modified, e.client_modified)
+
+    def test_folder(self):
+        e = DbxEntry.from_dict(data_folder_metadata)
+        self.assertTrue(e.is_folder)
+        self.assertEquals(0, e.size)
+        self.assertIsNone(e.rev)
+
+    def test_immutable(self):
+        e = DbxEntry.from_dict(data_file)
+        with self.assertRaises(AttributeError):
+            e.size = 1
+
+    def test_inode(self):
+        e = DbxEntry.from_dict(data_file)
+        self.assertEquals(e.inode, e._replace(path="/moved.odt", path_lower="/moved.odt").inode)
+        self.assertNotEqual(e.inode, DbxEntry.from_dict(data_folder_metadata).inode)
+        self.assertGreater(DbxEntry.from_dict({".tag": "folder", "path_lower": "/"}).inode, 1)
@@ -3,7 +3,7 @@
 from unittest import TestCase
 
 from ff4d import Dropbox
-from fuse import FuseOSError
+from fuse import FuseOSError, fuse_file_info
 from test_data import *
 
 
@@ -82,20 +82,41 @@ class TestDropbox(TestCase):
                             "/non_existent_path_87901ohufloih87014h187hdpjhf87190-A.txt")
         self.assertTrue('Input/output error' in context.exception)
 
+    # Dropbox is mounted with raw_fi, handle is returned in fuse_file_info
+    def _open(self, path):
+        fi = fuse_file_info(flags=0)
+        self.assertEquals(0, self.drb.open(path, fi))
+        self.assertGreater(fi.fh, 0)
+        return fi
+
+    def _create(self, path):
+        fi = fuse_file_info(flags=0)
+        self.assertEquals(0, self.drb.create(path, 0, fi))
+        self.assertGreater(fi.fh, 0)
+        return fi
+
     def test_open(self):
-        self.assertGreater(self.drb.open(self.lip01, 0), 0)
+        self._open(self.lip01)
         meta = self.drb.cache.get(self.lip01)
         self.assertEquals(self.lip01, meta.path)
 
+    def test_open_keep_cache(self):
+        fi = self._open(self.lip01)
+        self.assertEquals(0, fi.keep_cache)
+        self.assertEquals(0, self.drb.release(self.lip01, fi))
+        fi = self._open(self.lip01)
+        self.assertEquals(1, fi.keep_cache)
+        self.assertEquals(0, self.drb.release(self.lip01, fi))
+
     def test_create(self):
         new_file = remote_dir +'/new_file'
-        self.assertGreater(self.drb.create(new_file, 0), 0)
+        self._create(new_file)
         meta = self.drb.cache.get(new_file)
         self.assertEquals(new_file, meta.path)
 
     def test_read(self):
-        fh = self.drb.open(self.lip01, 0)
-        meta = self.drb.openfh.get_fh(fh)
+        fh = self._open(self.lip01)
+        meta = self.drb.openfh.get_fh(fh.fh)
         r = self.drb.read(meta.path, 10, 0, fh)
         self.assertEquals('Lorem ipsu', r)
         r = self.drb.read(meta.path, 10, 10, fh)
@@ -107,8 +128,7 @@ class TestDropbox(TestCase):
     def test_write(self):
         FileHandle.write_cache_size = 8192
         name = "/a/nn.txt"
-        fh = self.drb.create(name, 0)
-        self.assertGreater(fh, 0)
+        fh = self._create(name)
         buf = "A" * 4097
         of = self.drb.write(name, buf, 0, fh)
         self.assertEquals(4097, of)
@@ -122,15 +142,23 @@ class TestDropbox(TestCase):
         self.assertEquals(name, meta.path)
         self.assertEquals(of + of1 + of2, meta.size)
 
+    # Names listed by readdir, entries come with attributes
+    def _readdir(self, path):
+        return [x if isinstance(x, basestring) else x[0] for x in self.drb.readdir(path, 0)]
+
     def test_readdir(self):
-        r = self.drb.readdir('/', 0)
+        r = self._readdir('/')
         self.assertTrue('a' in r)
-        r = self.drb.readdir(remote_dir +'', 0)
+        r = self._readdir(remote_dir +'')
         self.assertTrue('lip01.txt' in r)
         self.assertTrue('lip10.txt' in r)
 
+    def test_readdir_attrs(self):
+        attrs = dict((x[0], x[1]) for x in self.drb.readdir(remote_dir +'', 0) if not isinstance(x, basestring))
+        self.assertEquals(self.drb.getattr(remote_dir +'/lip01.txt')['st_size'], attrs['lip01.txt']['st_size'])
+
     def test_getattr(self):
-        r = self.drb.readdir(remote_dir +'', 0)
+        r = self._readdir(remote_dir +'')
         a1 = self.drb.getattr(remote_dir +'/b')
         self.assertEquals(2, a1['st_nlink'])
         a1 = self.drb.getattr(remote_dir +'/lip01.txt')
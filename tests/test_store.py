@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from cache import ItemCache
+from dbxobject import DbxEntry, DbxObject
+from store import BlockStore, MetadataStore, StoreSync
+from test_data import *
+
+
+class TestMetadataStore(TestCase):
+    def setUp(self):
+        super(TestMetadataStore, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.store = MetadataStore(self.dir, 'dbid:account', '')
+        self.folder = DbxEntry.from_dict(data_folder_metadata)
+        self.entries = [DbxEntry.from_dict(x) for x in data_folder_entries['entries']]
+
+    def tearDown(self):
+        super(TestMetadataStore, self).tearDown()
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    def test_save_load(self):
+        self.assertIsNone(self.store.load_folder('/test'))
+        self.store.save_folder(self.folder, self.entries, 'cursor1')
+        folder, entries, cursor, listed = self.store.load_folder('/TEST')
+        self.assertEquals(self.folder, folder)
+        self.assertEquals(sorted(self.entries), sorted(entries))
+        self.assertEquals('cursor1', cursor)
+
+    def test_account_root(self):
+        self.store.save_folder(self.folder, self.entries, 'cursor1')
+        other = MetadataStore(self.dir, 'dbid:other', '')
+        self.assertIsNone(other.load_folder('/test'))
+        other.close()
+        other = MetadataStore(self.dir, 'dbid:account', '/app')
+        self.assertIsNone(other.load_folder('/test'))
+        other.close()
+
+    def test_delete(self):
+        self.store.save_folder(self.folder, self.entries, 'cursor1')
+        self.store.save_folder(self.entries[0], [DbxEntry.from_dict(data_file)], 'cursor2')
+        self.store.delete('/test/subfolder')
+        self.assertIsNone(self.store.load_folder('/test/subfolder'))
+        folder, entries, cursor, listed = self.store.load_folder('/test')
+        self.assertEquals(2, len(entries))
+        self.store.delete('/test')
+        self.assertIsNone(self.store.load_folder('/test'))
+
+    def test_cache_load(self):
+        self.store.save_folder(self.folder, self.entries, 'cursor1')
+        cache = ItemCache()
+        folder, entries, cursor, listed = self.store.load_folder('/test')
+        item = cache.load(folder, entries)
+        # Restored listing answers lookups but is not complete before revalidation
+        self.assertFalse(item.has_entries)
+        self.assertTrue(cache.is_restored('/test'))
+        self.assertTrue(cache.is_in_cache('/test/ss'))
+        cache.apply_changes([dict(data_folder_metadata_deleted, path_lower='/test/ss'), data_file])
+        self.assertFalse(cache.is_in_cache('/test/ss'))
+        self.assertEquals(19754, cache.get('/test/subfolder/a6w.odt').size)
+        cache.set_validated('/test')
+        self.assertTrue(item.has_entries)
+        self.assertFalse(cache.is_restored('/test'))
+
+    def test_cache_load_local_change(self):
+        self.store.save_folder(self.folder, self.entries, 'cursor1')
+        cache = ItemCache()
+        folder, entries, cursor, listed = self.store.load_folder('/test')
+        item = cache.load(folder, entries)
+        # File written through the mount invalidates restored listing
+        cache.remove('/test/new.txt')
+        cache.add(DbxObject(dict(data_file, path_lower='/test/new.txt', path_display='/test/new.txt')))
+        cache.remove('/test/new.txt')
+        cache.set_validated('/test')
+        self.assertFalse(item.has_entries)
+        self.assertFalse(cache.is_restored('/test'))
+
+
+class FakeApi(object):
+    def __init__(self, pages=(), listing=None):
+        self.pages = list(pages)
+        self.listing = listing
+        self.listed = []
+
+    def list_folder_continue(self, cursor):
+        return DbxObject(self.pages.pop(0))
+
+    def list_folder(self, path):
+        self.listed.append(path)
+        return DbxObject(self.listing)
+
+
+class TestStoreSync(TestCase):
+    def setUp(self):
+        super(TestStoreSync, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.store = MetadataStore(self.dir, 'dbid:account', '')
+        self.store.save_folder(DbxEntry.from_dict(data_folder_metadata),
+                               [DbxEntry.from_dict(x) for x in data_folder_entries['entries']], 'cursor1')
+        self.cache = ItemCache()
+
+    def tearDown(self):
+        super(TestStoreSync, self).tearDown()
+        self.store.close()
+        shutil.rmtree(self.dir)
+
+    # Restore /test and run queued tasks in place of the worker thread
+    def restore(self, api):
+        sync = StoreSync(api, self.cache, self.store)
+        self.assertTrue(sync.restore('/test'))
+        self.assertTrue(sync.restore('/test'))
+        while not sync._queue.empty():
+            task = sync._queue.get()
+            task[0](*task[1:])
+
+    def test_revalidate(self):
+        api = FakeApi(pages=[
+            {'entries': [dict(data_folder_metadata_deleted, path_lower='/test/ss')], 'cursor': 'cursor2',
+             'has_more': True},
+            {'entries': [], 'cursor': 'cursor3', 'has_more': False}])
+        self.restore(api)
+        self.assertEquals([], api.listed)
+        self.assertTrue(self.cache.get('/test').has_entries)
+        self.assertFalse(self.cache.is_restored('/test'))
+        self.assertFalse(self.cache.is_in_cache('/test/ss'))
+        folder, entries, cursor, listed = self.store.load_folder('/test')
+        self.assertEquals('cursor3', cursor)
+        self.assertEquals(2, len(entries))
+
+    def test_revalidate_invalid_cursor(self):
+        api = FakeApi(pages=[{'error': {'.tag': 'reset'}, 'error_summary': 'reset/'}],
+                      listing=dict(data_folder_entries, cursor='relisted', has_more=False))
+        self.restore(api)
+        self.assertEquals(['/test'], api.listed)
+        self.assertTrue(self.cache.get('/test').has_entries)
+        self.assertFalse(self.cache.is_restored('/test'))
+        folder, entries, cursor, listed = self.store.load_folder('/test')
+        self.assertEquals('relisted', cursor)
+        self.assertEquals(3, len(entries))
+
+    def test_revalidate_deleted(self):
+        api = FakeApi(pages=[{'error': {'.tag': 'reset'}, 'error_summary': 'reset/'}],
+                      listing=data_error_path_not_found)
+        self.restore(api)
+        self.assertFalse(self.cache.is_in_cache('/test'))
+        self.assertIsNone(self.store.load_folder('/test'))
+
+
+class TestBlockStore(TestCase):
+    def setUp(self):
+        super(TestBlockStore, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.store = BlockStore(self.dir)
+        self.store.max_bytes = 10
+
+    def tearDown(self):
+        super(TestBlockStore, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def test_get_put(self):
+        self.assertIsNone(self.store.get('1d7c6680', 4, 0))
+        self.assertEquals('0123', self.store.put('1d7c6680', 4, 0, '0123')[:])
+        self.assertEquals('0123', self.store.get('1d7c6680', 4, 0)[:])
+        self.assertIsNone(self.store.get('1d7c6680', 8, 0))
+        self.assertEquals('0123', BlockStore(self.dir).get('1d7c6680', 4, 0)[:])
+
+    def test_get_truncated(self):
+        self.store.put('1d7c6680', 4, 0, '0123')
+        path = os.path.join(self.store.dir, self.store._name('1d7c6680', 4, 0))
+        with open(path, 'wb') as f:
+            f.write('01')
+        self.assertIsNone(self.store.get('1d7c6680', 4, 0))
+        self.assertEquals(0, self.store.bytes)
+        self.assertFalse(os.path.exists(path))
+
+    def test_evict(self):
+        self.store.put('1d7c6680', 4, 0, '0123')
+        self.store.put('1d7c6680', 4, 1, '4567')
+        self.store.get('1d7c6680', 4, 0)
+        self.store.put('1d7c6680', 4, 2, '89ab')
+        self.assertIsNone(self.store.get('1d7c6680', 4, 1))
+        self.assertEquals(8, self.store.bytes)
+        self.assertEquals(8, BlockStore(self.dir).bytes)
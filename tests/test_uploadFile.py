@@ -36,6 +36,23 @@ class TestUploadFile(TestCase):
         self.u.flush()
         self.assertEquals("",self.u.buf)
 
+    def test_view(self):
+        self.u.buf = "abcdef"
+        view = self.u.view(2, 4)
+        self.assertEquals("cd", view.tobytes())
+        self.u.flush()
+        self.u.buf = "xyz"
+        self.assertEquals("cd", view.tobytes())
+        self.assertEquals("xyz", self.u.view().tobytes())
+
+    def test_take(self):
+        self.u.buf = "abcdef"
+        self.assertEquals("abcd", self.u.take(4))
+        self.assertEquals("ef", self.u.buf)
+        self.assertEquals("ef", self.u.take(4))
+        self.assertEquals(0, self.u.buf_size)
+        self.assertEquals(0, self.u.offset)
+
     def test_buf_size(self):
         self.assertEquals(0,self.u.buf_size)
         self.u.buf = "abc"
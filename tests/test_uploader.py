@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from unittest import TestCase
+
+from dbxobject import DbxObject, FileHandle
+from uploader import CommitBatch, Uploader
+
+
+class FakeApi(object):
+    def __init__(self, fail_at=None):
+        self.chunks = []
+        self.fail_at = fail_at
+        self.started = threading.Event()
+        self.resume = threading.Event()
+        self.resume.set()
+
+    def upload(self, upload_file, chunk=None):
+        self.started.set()
+        self.resume.wait()
+        if len(self.chunks) == self.fail_at:
+            upload_file.upload_status = DbxObject({'error': {'.tag': 'too_large'}, 'error_summary': 'too_large/'})
+            return upload_file
+        self.chunks.append((upload_file.offset, str(chunk)))
+        upload_file.upload_status = DbxObject({})
+        upload_file.offset += len(chunk)
+        return upload_file
+
+    def start_upload(self, body="", concurrent=False):
+        self.concurrent = concurrent
+        return DbxObject({'session_id': 'session'})
+
+    def append_upload(self, session_id, offset, body, close=False):
+        if len(self.chunks) == self.fail_at:
+            return DbxObject({'error': {'.tag': 'closed'}, 'error_summary': 'closed/'})
+        self.chunks.append((offset, body.tobytes(), close))
+        return DbxObject({})
+
+
+class TestUploader(TestCase):
+    def setUp(self):
+        super(TestUploader, self).setUp()
+        self.u = FileHandle.new_upload_file_handle('/test.txt')
+
+    def test_put(self):
+        api = FakeApi()
+        uploader = Uploader(api, self.u)
+        for data in ('abc', 'def', 'gh'):
+            self.u.buf = data
+            uploader.put(self.u.take())
+        self.assertEquals(0, self.u.buf_size)
+        uploader.close()
+        self.assertEquals([(0, 'abc'), (3, 'def'), (6, 'gh')], api.chunks)
+        self.assertEquals(8, self.u.offset)
+
+    def test_put_bounded(self):
+        api = FakeApi()
+        api.resume.clear()
+        uploader = Uploader(api, self.u)
+        uploader.put(bytearray('abc'))
+        api.started.wait(5)
+        # Worker is busy with the first chunk, depth more chunks fit in the queue
+        uploader.put(bytearray('def'))
+        uploader.put(bytearray('gh'))
+        self.assertTrue(uploader._queue.full())
+        api.resume.set()
+        uploader.close()
+        self.assertEquals([(0, 'abc'), (3, 'def'), (6, 'gh')], api.chunks)
+
+    def test_error(self):
+        api = FakeApi(fail_at=1)
+        uploader = Uploader(api, self.u)
+        uploader.put(bytearray('abc'))
+        uploader.put(bytearray('def'))
+        uploader.put(bytearray('gh'))
+        self.assertRaises(IOError, uploader.close)
+        self.assertRaises(IOError, uploader.put, bytearray('ij'))
+        self.assertEquals([(0, 'abc')], api.chunks)
+
+    def test_close_last(self):
+        api = FakeApi()
+        uploader = Uploader(api, self.u)
+        uploader.put(bytearray('abc'))
+        uploader.close(bytearray('de'))
+        self.assertEquals([(0, 'abc'), (3, 'de')], api.chunks)
+        self.assertEquals(5, self.u.offset)
+
+
+class TestConcurrentUploader(TestCase):
+    def setUp(self):
+        super(TestConcurrentUploader, self).setUp()
+        self.u = FileHandle.new_upload_file_handle('/test.txt')
+        Uploader.streams = 3
+
+    def tearDown(self):
+        Uploader.streams = 1
+        super(TestConcurrentUploader, self).tearDown()
+
+    def test_close(self):
+        api = FakeApi()
+        uploader = Uploader(api, self.u)
+        for data in ('abc', 'def', 'ghi', 'jkl'):
+            uploader.put(bytearray(data))
+        uploader.close(bytearray('mn'))
+        self.assertTrue(api.concurrent)
+        self.assertEquals('session', self.u.session_id)
+        self.assertEquals([(0, 'abc', False), (3, 'def', False), (6, 'ghi', False), (9, 'jkl', False)],
+                          sorted(api.chunks[:-1]))
+        # Closing append follows all other chunks
+        self.assertEquals((12, 'mn', True), api.chunks[-1])
+        self.assertEquals(14, self.u.offset)
+
+    def test_close_empty(self):
+        api = FakeApi()
+        uploader = Uploader(api, self.u)
+        uploader.put(bytearray('abc'))
+        uploader.close(bytearray())
+        self.assertEquals([(0, 'abc', False), (3, '', True)], api.chunks)
+
+    def test_error(self):
+        api = FakeApi(fail_at=0)
+        uploader = Uploader(api, self.u)
+        uploader.put(bytearray('abc'))
+        self.assertRaises(IOError, uploader.close, bytearray('de'))
+        self.assertEquals([], api.chunks)
+
+
+class FakeBatchApi(object):
+    def __init__(self, checks=0, failures=(), batch_error=False, commit_errors=()):
+        self.batches = []
+        self.commits = []
+        self.checks = checks
+        self.failures = failures
+        self.batch_error = batch_error
+        self.commit_errors = commit_errors
+
+    def finish_batch(self, upload_files):
+        self.batches.append([f.path for f in upload_files])
+        if self.batch_error:
+            raise Exception('apiRequest failed. Socket error')
+        self.entries = [{'.tag': 'failure', 'failure': {'.tag': 'too_many_write_operations'}}
+                        if f.path in self.failures else {'.tag': 'success', 'path_display': f.path}
+                        for f in upload_files]
+        if self.checks:
+            return DbxObject({'.tag': 'async_job_id', 'async_job_id': 'job'})
+        return DbxObject({'.tag': 'complete', 'entries': self.entries})
+
+    def finish_batch_check(self, async_job_id):
+        self.checks -= 1
+        if self.checks:
+            return DbxObject({'.tag': 'in_progress'})
+        return DbxObject({'.tag': 'complete', 'entries': self.entries})
+
+    def commit_upload(self, upload_file):
+        self.commits.append(upload_file.path)
+        if upload_file.path in self.commit_errors:
+            upload_file.result = DbxObject({'error': {'.tag': 'path'}, 'error_summary': 'path/conflict/'})
+        else:
+            upload_file.result = DbxObject({'path_display': upload_file.path})
+        return upload_file
+
+
+class TestCommitBatch(TestCase):
+    def setUp(self):
+        super(TestCommitBatch, self).setUp()
+        self.files = [FileHandle.new_upload_file_handle('/test%s.txt' % i) for i in range(3)]
+
+    def _batch(self, api):
+        batch = CommitBatch(api)
+        batch.window = 0.05
+        batch.poll_interval = 0.01
+        batch.max_entries = 2
+        batch.start()
+        return batch
+
+    def test_commit(self):
+        api = FakeBatchApi()
+        batch = self._batch(api)
+        for f in self.files:
+            batch.add(f)
+        batch.wait('/TEST2.txt')
+        batch.flush()
+        self.assertEquals([['/test0.txt', '/test1.txt'], ['/test2.txt']], api.batches)
+        self.assertEquals('success', self.files[2].result.tag)
+
+    def test_check(self):
+        api = FakeBatchApi(checks=3)
+        batch = self._batch(api)
+        batch.add(self.files[0])
+        batch.wait('/test0.txt')
+        self.assertEquals(0, api.checks)
+        self.assertEquals('/test0.txt', self.files[0].result.path)
+
+    def test_entry_failure(self):
+        api = FakeBatchApi(failures=('/test1.txt',))
+        batch = self._batch(api)
+        for f in self.files:
+            batch.add(f)
+        batch.flush()
+        # Failed entry is finished on its own
+        self.assertEquals(['/test1.txt'], api.commits)
+        self.assertTrue(batch.wait('/test1.txt'))
+
+    def test_batch_failure(self):
+        api = FakeBatchApi(batch_error=True, commit_errors=('/test0.txt',))
+        batch = self._batch(api)
+        batch.add(self.files[0])
+        batch.add(self.files[1])
+        self.assertFalse(batch.wait('/test0.txt'))
+        # Failure is reported once
+        self.assertTrue(batch.wait('/test0.txt'))
+        self.assertTrue(batch.wait('/test1.txt'))
+        self.assertEquals(['/test0.txt', '/test1.txt'], api.commits)
+
+    def test_wait_folder(self):
+        api = FakeBatchApi()
+        batch = CommitBatch(api)
+        batch.add(self.files[0])
+        batch.wait_folder('/other')
+        worker = threading.Thread(target=batch.wait_folder, args=('/',))
+        worker.start()
+        worker.join(0.05)
+        self.assertTrue(worker.is_alive())
+        batch.window = 0.01
+        batch.start()
+        worker.join(5)
+        self.assertFalse(worker.is_alive())
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+
+import watcher
+from cache import ItemCache
+from dbxobject import DbxObject
+from test_data import *
+from watcher import ChangeWatcher, prefetch_tree
+
+
+class FakeApi(object):
+    def __init__(self, polls=(), pages=()):
+        self.polls = list(polls)
+        self.pages = list(pages)
+        self.cursors = 0
+        self.continued = []
+
+    def get_latest_cursor(self, path, recursive=False):
+        self.cursors += 1
+        return DbxObject({'cursor': 'latest%s' % self.cursors})
+
+    def longpoll(self, cursor, timeout, pool=None):
+        return DbxObject(self.polls.pop(0))
+
+    def list_folder_continue(self, cursor):
+        self.continued.append(cursor)
+        return DbxObject(self.pages.pop(0))
+
+    def get_folder_item(self, path):
+        return DbxObject(data_folder_metadata)
+
+    def list_folder_pages(self, path, recursive=False):
+        for page in self.pages:
+            yield DbxObject(page)
+
+
+class TestChangeWatcher(TestCase):
+    def setUp(self):
+        super(TestChangeWatcher, self).setUp()
+        self.cache = ItemCache()
+        self.folder = self.cache.add(DbxObject(data_folder_entries))
+        self.sleeps = []
+        self.sleep = watcher.sleep
+        watcher.sleep = self.sleeps.append
+
+    def tearDown(self):
+        watcher.sleep = self.sleep
+        super(TestChangeWatcher, self).tearDown()
+
+    def test_poll_no_changes(self):
+        api = FakeApi(polls=[{'changes': False}])
+        w = ChangeWatcher(api, self.cache, '/test')
+        w.poll()
+        self.assertEquals('latest1', w.cursor)
+        self.assertEquals([], api.continued)
+        self.assertEquals([], self.sleeps)
+        self.assertFalse(self.folder.is_expired)
+
+    def test_poll_apply_pages(self):
+        api = FakeApi(polls=[{'changes': True}], pages=[
+            {'entries': [{".tag": "deleted", "path_lower": "/test/ss", "path_display": "/test/ss"}],
+             'cursor': 'page1', 'has_more': True},
+            {'entries': [dict(data_file, path_lower="/test/new.odt", path_display="/test/New.odt")],
+             'cursor': 'page2', 'has_more': False}])
+        w = ChangeWatcher(api, self.cache, '/test')
+        w.poll()
+        self.assertEquals(['latest1', 'page1'], api.continued)
+        self.assertEquals('page2', w.cursor)
+        self.assertFalse(self.cache.is_in_cache("/test/ss"))
+        self.assertEquals("/test/New.odt", self.folder.get_entry("/test/new.odt").path)
+        self.assertTrue(self.folder.has_entries)
+
+    def test_poll_invalid_cursor(self):
+        api = FakeApi(polls=[{'changes': False}, {'error': {'.tag': 'reset'}, 'error_summary': 'reset/'}])
+        w = ChangeWatcher(api, self.cache, '/test')
+        w.poll()
+        self.assertFalse(self.folder.is_expired)
+        w.poll()
+        self.assertEquals('latest2', w.cursor)
+        # Changes made before the new cursor are unknown
+        self.assertTrue(self.folder.is_expired)
+
+    def test_apply_invalid_cursor(self):
+        api = FakeApi(polls=[{'changes': True}], pages=[{'error': {'.tag': 'reset'}, 'error_summary': 'reset/'}])
+        w = ChangeWatcher(api, self.cache, '/test')
+        w.cursor = 'old'
+        w.poll()
+        self.assertEquals(['old'], api.continued)
+        self.assertEquals('latest1', w.cursor)
+        self.assertTrue(self.folder.is_expired)
+
+    def test_poll_backoff(self):
+        api = FakeApi(polls=[{'changes': False, 'backoff': 60}])
+        w = ChangeWatcher(api, self.cache, '/test')
+        w.poll()
+        self.assertEquals([60], self.sleeps)
+
+    def test_reset_failed(self):
+        api = FakeApi()
+        api.get_latest_cursor = lambda path, recursive=False: DbxObject(data_error_path_not_found)
+        w = ChangeWatcher(api, self.cache, '/test')
+        self.assertRaises(Exception, w.poll)
+        self.assertIsNone(w.cursor)
+
+
+class TestPrefetchTree(TestCase):
+    def setUp(self):
+        super(TestPrefetchTree, self).setUp()
+        self.cache = ItemCache()
+
+    def test_prefetch(self):
+        api = FakeApi(pages=[data_folder_entries_recursive])
+        cursor = prefetch_tree(api, self.cache, '/test')
+        self.assertEquals(data_folder_entries_recursive['cursor'], cursor)
+        self.assertTrue(self.cache.get('/test').has_entries)
+        self.assertTrue(self.cache.get('/test/subfolder').has_entries)
+        # Empty folder is known to be empty
+        self.assertTrue(self.cache.get('/test/ss').has_entries)
+        self.assertEquals(3, len(self.cache.get('/test/subfolder').sub_items))
+
+    def test_prefetch_evictions(self):
+        self.cache.max_entries = 4
+        api = FakeApi(pages=[data_folder_entries_recursive])
+        cursor = prefetch_tree(api, self.cache, '/test')
+        self.assertEquals(data_folder_entries_recursive['cursor'], cursor)
+        self.assertTrue(self.cache.evictions > 0)
+        # Listings are not complete, folders are listed on access
+        for path in ('/test', '/test/subfolder', '/test/ss'):
+            item = self.cache.get(path)
+            self.assertFalse(item is not None and item.has_entries)
+
+    def test_prefetch_error(self):
+        api = FakeApi(pages=[data_error])
+        self.assertIsNone(prefetch_tree(api, self.cache, '/test'))
+        self.assertFalse(self.cache.get('/test').has_entries)
+
+    def test_prefetch_not_folder(self):
+        api = FakeApi()
+        api.get_folder_item = lambda path: DbxObject(data_file)
+        self.assertIsNone(prefetch_tree(api, self.cache, '/test'))
+        self.assertFalse(self.cache.is_in_cache('/test'))
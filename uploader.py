@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import threading
+from Queue import Queue
+from time import sleep, time
+
+from cache import cache_key
+from dbxobject import DbxObject
+
+logger = logging.getLogger(__name__)
+
+
+class Uploader(object):
+    """
+    Background upload of one file handle opened for writing.
+    Full chunks are appended to the upload session by worker threads while the next chunk is filling.
+    With one stream chunks are appended in write order, with more streams the session is concurrent and
+    chunks are appended at their own offsets in parallel, the closing append follows all others.
+    The queue is bounded, writers block while depth chunks are waiting for the network.
+    """
+    # Max number of full chunks waiting for upload
+    depth = 2
+    # Number of parallel append streams, chunks have to be multiples of 4 MB with more than one
+    streams = 1
+
+    def __init__(self, api, upload_file):
+        super(Uploader, self).__init__()
+        self.ar = api
+        self.upload_file = upload_file
+        self.concurrent = self.streams > 1
+        # Error summary of failed chunk, later chunks are dropped
+        self.error = None
+        # Offset of the next queued chunk
+        self._offset = upload_file.offset
+        self._lock = threading.Lock()
+        self._queue = Queue(self.depth)
+        self._workers = []
+        for i in range(self.streams):
+            worker = threading.Thread(target=self._run, name='Upload-%s-%s' % (upload_file.path, i))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    # Queue chunk for upload, raises IOError if an earlier chunk failed
+    def put(self, chunk):
+        self._check()
+        self._queue.put((self._offset, chunk))
+        self._offset += len(chunk)
+
+    # Upload the last chunk, wait for queued chunks and stop workers, raises IOError if any chunk failed
+    def close(self, last=None):
+        last = last or bytearray()
+        try:
+            if not self.concurrent:
+                if last:
+                    self.put(last)
+                self._queue.join()
+            else:
+                self._queue.join()
+                if self.error is None:
+                    # Session is closed by the final append, possibly empty
+                    self._upload(self._offset, last, close=True)
+                    self._offset += len(last)
+                    self.upload_file.offset = self._offset
+        except Exception as e:
+            self._fail(e)
+        finally:
+            for worker in self._workers:
+                self._queue.put(None)
+            for worker in self._workers:
+                worker.join()
+        self._check()
+
+    def _check(self):
+        if self.error is not None:
+            raise IOError('Could not upload %s: %s' % (self.upload_file.path, self.error))
+
+    def _fail(self, e):
+        logger.debug(e, exc_info=True)
+        self.error = self.error or str(e) or 'upload failed'
+        logger.error('Uploading chunk of %s failed: %s', self.upload_file.path, self.error)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                # Queue is drained after failure so writers do not block
+                if self.error is None:
+                    self._upload(*item)
+            except Exception as e:
+                self._fail(e)
+            finally:
+                self._queue.task_done()
+
+    def _upload(self, offset, chunk, close=False):
+        if not self.concurrent:
+            status = self.ar.upload(self.upload_file, chunk).upload_status
+        else:
+            status = self.ar.append_upload(self._session(), offset, memoryview(chunk), close)
+        if status.is_error:
+            raise IOError(status.error_summary or 'upload failed')
+
+    # Session id of concurrent session, started by the first chunk
+    def _session(self):
+        with self._lock:
+            if not self.upload_file.is_session_open:
+                status = self.ar.start_upload(concurrent=True)
+                if status.is_error:
+                    raise IOError(status.error_summary or 'could not start upload session')
+                self.upload_file.upload_status = status
+                self.upload_file.update_session_id()
+            return self.upload_file.session_id
+
+
+class CommitBatch(object):
+    """
+    Commits closed upload sessions of many files together by upload_session/finish_batch.
+    Sessions are gathered for window seconds or up to max_entries, finish_batch/check is polled until the batch is done.
+    Paths stay pending until their batch is committed, wait blocks meanwhile.
+    Sessions not committed by the batch are finished one by one, paths failing even then are reported by wait.
+    """
+    # Seconds to gather sessions, 0 disables batching
+    window = 0
+    # Max entries of one finish_batch request
+    max_entries = 1000
+    # Seconds between finish_batch/check requests
+    poll_interval = 0.5
+
+    def __init__(self, api):
+        super(CommitBatch, self).__init__()
+        self.ar = api
+        self._cond = threading.Condition()
+        self._entries = []
+        # Number of uncommitted sessions by cache key of path
+        self._pending = {}
+        # Cache keys of paths which could not be committed, not reported yet
+        self._failed = set()
+
+    # Worker thread has to be started after FUSE has daemonized
+    def start(self):
+        if self.window <= 0:
+            return
+        worker = threading.Thread(target=self._run, name='CommitBatch')
+        worker.daemon = True
+        worker.start()
+
+    # Queue closed session of upload_file for commit
+    def add(self, upload_file):
+        key = cache_key(upload_file.path)
+        with self._cond:
+            self._entries.append(upload_file)
+            self._pending[key] = self._pending.get(key, 0) + 1
+            self._cond.notify_all()
+
+    # Block until sessions of path are committed, returns False once if commit of path failed
+    def wait(self, path):
+        key = cache_key(path)
+        with self._cond:
+            while key in self._pending:
+                self._cond.wait()
+            if key in self._failed:
+                self._failed.discard(key)
+                return False
+        return True
+
+    # Block until sessions of entries in folder are committed
+    def wait_folder(self, path):
+        key = cache_key(path).rstrip('/')
+        with self._cond:
+            while any(os.path.dirname(x).rstrip('/') == key for x in self._pending):
+                self._cond.wait()
+
+    # Block until all queued sessions are committed
+    def flush(self):
+        with self._cond:
+            while self._pending:
+                self._cond.wait()
+
+    def _run(self):
+        while True:
+            batch = self._next()
+            try:
+                self._commit(batch)
+            except Exception as e:
+                logger.error('Could not commit %s uploaded files', len(batch))
+                logger.debug(e, exc_info=True)
+                self._fail(batch)
+            finally:
+                self._done(batch)
+
+    # Wait for first session, gather others for window seconds
+    def _next(self):
+        with self._cond:
+            while not self._entries:
+                self._cond.wait()
+            deadline = time() + self.window
+            while len(self._entries) < self.max_entries and deadline > time():
+                self._cond.wait(deadline - time())
+            batch, self._entries = self._entries[:self.max_entries], self._entries[self.max_entries:]
+        return batch
+
+    def _commit(self, batch):
+        logger.debug('Committing batch of %s uploaded files', len(batch))
+        try:
+            entries = self._finish_batch(batch)
+        except Exception as e:
+            logger.warning('Batch commit of %s files failed, committing them one by one', len(batch))
+            logger.debug(e, exc_info=True)
+            entries = []
+        failed = []
+        for i, upload_file in enumerate(batch):
+            result = DbxObject(entries[i]) if i < len(entries) else None
+            if result is not None and result.tag == 'success':
+                upload_file.result = result
+            # Closed session stays valid, it is finished on its own
+            elif not self._commit_single(upload_file):
+                failed.append(upload_file)
+        self._fail(failed)
+
+    # Returns True if session of upload_file has been committed by upload_session/finish
+    def _commit_single(self, upload_file):
+        try:
+            result = self.ar.commit_upload(upload_file).result
+            if not result.is_error:
+                return True
+            logger.debug('Commit failure: %s', result.error_summary)
+        except Exception as e:
+            logger.debug(e, exc_info=True)
+        logger.error('Could not commit remote file: %s', upload_file.path)
+        return False
+
+    def _fail(self, upload_files):
+        with self._cond:
+            self._failed.update(cache_key(x.path) for x in upload_files)
+
+    # Returns result entries of finish_batch, in order of batch
+    def _finish_batch(self, batch):
+        result = self.ar.finish_batch(batch)
+        if not result.is_error and result.tag == 'async_job_id':
+            job = result.get_key('async_job_id')
+            result = DbxObject({'.tag': 'in_progress'})
+            while not result.is_error and result.tag == 'in_progress':
+                sleep(self.poll_interval)
+                result = self.ar.finish_batch_check(job)
+        if result.is_error or result.tag != 'complete':
+            raise IOError('Batch commit failed: %s' % (result.error_summary or result.tag))
+        return result.entries
+
+    def _done(self, batch):
+        with self._cond:
+            for upload_file in batch:
+                key = cache_key(upload_file.path)
+                self._pending[key] -= 1
+                if not self._pending[key]:
+                    del self._pending[key]
+            self._cond.notify_all()
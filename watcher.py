@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+from time import sleep, time
+
+from dbxapi import ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+
+# Cache whole subtree of path with recursive listing, returns cursor of the listing
+def prefetch_tree(api, cache, path):
+    logger.info('Prefetching tree: %s', path)
+    started = time()
+    evictions = cache.evictions
+    item = api.get_folder_item(path)
+    if item.is_error or not item.is_folder:
+        logger.error('Could not prefetch: %s, not a folder', path)
+        return None
+    folder = cache.add(item)
+    count = 0
+    for page in api.list_folder_pages(path, recursive=True):
+        if page.is_error:
+            logger.error('Could not prefetch: %s, error:%s', path, page.error_summary)
+            return None
+        count += len(cache.add_page(folder, page))
+    # Listings are incomplete if cache limits forced eviction meanwhile
+    if cache.evictions != evictions:
+        logger.warning('Cache limits exceeded while prefetching %s, folders will be listed on access', path)
+    else:
+        cache.set_tree_listed(folder, started)
+    logger.info('Prefetched %s entries of %s in %.1fs', count, path, time() - started)
+    return page.cursor
+
+
+class ChangeWatcher(threading.Thread):
+    """
+    Background worker following remote changes of mounted folder.
+    Keeps recursive cursor of the root, blocks on list_folder/longpoll and applies
+    list_folder/continue changes to ItemCache in place.
+    """
+    # Longpoll timeout in seconds, Dropbox adds up to 90s of jitter
+    timeout = 30
+    # Delay after failed request in seconds
+    retry_delay = 10
+
+    def __init__(self, api, cache, path):
+        super(ChangeWatcher, self).__init__(name='ChangeWatcher')
+        self.daemon = True
+        self.ar = api
+        self.cache = cache
+        self.path = path
+        self.cursor = None
+        # Longpoll connection is kept open longer than regular requests
+        self.pool = ConnectionPool()
+        self.pool.timeout = self.timeout + 120
+
+    def run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                logger.error('Watching changes of %s failed, retrying in %ss', self.path, self.retry_delay)
+                logger.debug(e, exc_info=True)
+                sleep(self.retry_delay)
+
+    # Wait for one batch of changes and apply it
+    def poll(self):
+        if self.cursor is None:
+            self.reset()
+        result = self.ar.longpoll(self.cursor, self.timeout, pool=self.pool)
+        if result.is_error:
+            logger.info('Change cursor of %s is not valid any more: %s', self.path, result.error_summary)
+            self.reset()
+        elif result.get_key('changes'):
+            self.cursor = self.apply(self.cursor)
+        backoff = result.get_key('backoff')
+        if backoff:
+            sleep(backoff)
+
+    # Get fresh cursor, changes made meanwhile are unknown so cached data expires
+    def reset(self):
+        result = self.ar.get_latest_cursor(self.path, recursive=True)
+        if result.is_error:
+            raise Exception('Could not get cursor of %s: %s' % (self.path, result.error_summary))
+        if self.cursor is not None:
+            self.cache.expire(self.path)
+        self.cursor = result.cursor
+
+    # Apply all pages of changes, returns cursor
+    def apply(self, cursor):
+        while True:
+            page = self.ar.list_folder_continue(cursor)
+            if page.is_error:
+                self.reset()
+                return self.cursor
+            changes = self.cache.apply_changes(page.entries)
+            logger.debug('Applied %s of %s remote changes', changes, len(page.entries))
+            cursor = page.cursor
+            if not page.has_more:
+                return cursor